@@ -0,0 +1,764 @@
+from utilities.image_creator import draw_post_card, draw_comment_card, format_post_document, \
+    format_comment_document, decode_screenshot, trim_image
+from utilities.post_collector import append_posts, rank_posts
+from utilities.voiceover_creator import format_ssml, format_ssml_batch, ToneBackend, Voiceover
+from utilities.background_library import BackgroundLibrary, probe_background, crop_box, \
+    INDEX_NAME, OUTPUT_SIZE
+from utilities.video_creator import VIDEO_BACKENDS, TRACK_RATE, voiceover_track
+from utilities.render_pool import get_render_pool
+from utilities.mp3_parser import mp3_duration
+from utilities.records import Comment
+from PIL import Image
+from dataclasses import asdict
+import numpy as np
+import imageio_ffmpeg
+import subprocess
+import tempfile
+import tracemalloc
+import argparse
+import random
+import pandas
+import time
+import sys
+import os
+
+
+# The largest fraction of a pillow card's pixels that may be off by more than 32 from the
+# browser render of the same card, even allowing for a DRIFT_PIXELS shift along the line.
+# Measured against Chromium 140 on 100 posts and comments: cards with the same layout were
+# at most 8.3% off, and a word wrapping onto the next line at the edge of the text box
+# made it up to 17.1%. A missing or misplaced element goes well past this.
+MAX_CARD_CHANGED = 0.2
+# Pillow's hinted glyph advances are slightly narrower than the browser's, so text drifts
+# up to this many pixels by the end of a line
+DRIFT_PIXELS = 2
+
+
+def time_call(function, *args, repeat=3):
+    '''
+    Call a function several times and return the best wall time in seconds
+    along with the result of the last call.
+    '''
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def synthetic_listing(num_posts, seed=0):
+    '''
+    Create a fake Reddit listing shaped like the children of a top.json response.
+    '''
+    rng = random.Random(seed)
+    words = ["the", "a", "reddit", "joke", "story", "customer", "manager", "dad", "why", "because"]
+    urls = ["https://www.reddit.com/r/Jokes/comments/abc/", "https://i.redd.it/abc.jpg",
+            "https://i.imgur.com/abc.png", "https://v.redd.it/abc"]
+
+    listing = []
+    for i in range(num_posts):
+        num_awards = rng.choice([0, 0, 0, 0, 1, 2])
+        listing.append({'data': {
+            'title': " ".join(rng.choices(words, k=rng.randint(3, 15))),
+            'selftext': " ".join(rng.choices(words, k=rng.randint(0, 250))),
+            'author': f"user_{i}",
+            'id': f"id{i}",
+            'name': f"t3_id{i}",
+            'ups': rng.randint(0, 50000),
+            'total_awards_received': num_awards,
+            'all_awardings': [{'icon_url': "https://i.redd.it/award.png"}] * num_awards,
+            'num_comments': rng.randint(0, 3000),
+            'url': rng.choice(urls),
+            'over_18': rng.random() < 0.05,
+            'subreddit': "Jokes",
+        }})
+
+    return listing
+
+
+def legacy_accumulate(listing):
+    '''
+    The original row-by-row dataframe construction, kept as a baseline.
+    '''
+    df = pandas.DataFrame()
+    for post in listing:
+        post = post['data']
+        awards = []
+        if post['total_awards_received'] != 0:
+            for award in post['all_awardings']:
+                awards.append(award['icon_url'])
+
+        post_data = pandas.DataFrame([{
+            'title': post['title'],
+            'body': post['selftext'],
+            'author': post['author'],
+            'id': post['id'],
+            'upvotes': post['ups'],
+            'num_awards': post['total_awards_received'],
+            'num_comments': post['num_comments'],
+            'url': post['url'],
+            'awards': awards,
+            'nsfw': post['over_18'],
+            'subreddit': post['subreddit'],
+            'postability': 0.0
+        }])
+        df = pandas.concat([df, post_data], ignore_index=True)
+
+    return df
+
+
+def legacy_rank_posts(df, bounds, widen_factor=0):
+    '''
+    The original iloc based ranking loop, kept as a baseline.
+    '''
+    default_bounds = tuple(map(int, bounds.split(",")))
+    bounds = (max(0, default_bounds[0] - widen_factor), (default_bounds[1] + widen_factor))
+
+    drop_indices = []
+    for index in range(df.shape[0]):
+        wordcount = len(df.iloc[index]['body'].split(" ")) + len(df.iloc[index]['title'].split(" "))
+
+        contains_image = False
+        if "jpg" in df.iloc[index]['url'] or "jpeg" in df.iloc[index]['url'] or \
+        "png" in df.iloc[index]['url'] or "gif" in df.iloc[index]['url']:
+            contains_image = True
+
+        if wordcount not in range(*bounds) or df.iloc[index]['nsfw'] or contains_image:
+            drop_indices.append(index)
+        else:
+            postability = (df.iloc[index]['upvotes'] / 10) * wordcount * (20**df.iloc[index]['num_awards'])
+            df.at[index, 'postability'] = postability
+
+    df.drop(drop_indices, inplace=True)
+    df = df.sort_values(by='postability', ascending=False, kind='stable')
+
+    return df
+
+
+def record_accumulate(listing):
+    '''
+    Build the post records the way accumulate_posts does now.
+    '''
+    posts = []
+    append_posts(posts, listing)
+
+    return posts
+
+
+def benchmark_ranking(num_posts, bounds):
+    '''
+    Compare the original and columnar scrape phase on a synthetic listing
+    and check that both produce the same ranking.
+    '''
+    listing = synthetic_listing(num_posts)
+
+    legacy_build, legacy_df = time_call(legacy_accumulate, listing, repeat=1)
+    legacy_rank, legacy_ranked = time_call(lambda: legacy_rank_posts(legacy_df.copy(), bounds), repeat=1)
+    build, posts = time_call(record_accumulate, listing)
+    rank, ranked = time_call(rank_posts, posts, bounds)
+
+    same = list(legacy_ranked['id']) == [post.id for post in ranked]
+
+    print(f"{num_posts} posts, bounds {bounds}")
+    print(f"  build posts:     {legacy_build:.3f}s -> {build:.3f}s ({legacy_build / build:.0f}x)")
+    print(f"  rank posts:      {legacy_rank:.3f}s -> {rank:.3f}s ({legacy_rank / rank:.0f}x)")
+    print(f"  same ranking:    {same}")
+
+
+def startup_cost(statement):
+    '''
+    Run an import statement in a fresh interpreter and return how long it took
+    in seconds along with the interpreter's peak RSS in MB (0 where /proc isn't available).
+    '''
+    # VmHWM is used rather than ru_maxrss, which can include the parent's RSS from before exec
+    report = "import os; print(open('/proc/self/status').read() if os.path.exists('/proc/self/status') else '')"
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", f"{statement}; {report}"],
+                            check=True, capture_output=True, text=True).stdout
+    elapsed = time.perf_counter() - start
+
+    peak = [line.split()[1] for line in output.splitlines() if line.startswith("VmHWM")]
+
+    return elapsed, int(peak[0]) / 1024 if peak else 0
+
+
+def benchmark_records(num_posts):
+    '''
+    Compare the startup cost and memory of the collectors against pandas,
+    and the memory of holding a synthetic listing as a dataframe and as post records.
+    '''
+    listing = synthetic_listing(num_posts)
+
+    tracemalloc.start()
+    frame = pandas.DataFrame([post['data'] for post in listing])
+    legacy = tracemalloc.get_traced_memory()[1] / 1e6
+    del frame
+    tracemalloc.reset_peak()
+    posts = record_accumulate(listing)
+    records = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+
+    pandas_time, pandas_rss = startup_cost("import pandas")
+    collector_time, collector_rss = startup_cost("import utilities.post_collector, utilities.comment_collector")
+
+    print(f"{num_posts} posts")
+    print(f"  listing memory: {legacy:.1f}MB dataframe -> {records:.1f}MB records")
+    print(f"  import pandas:     {pandas_time:.2f}s, {pandas_rss:.0f}MB peak RSS")
+    print(f"  import collectors: {collector_time:.2f}s, {collector_rss:.0f}MB peak RSS")
+
+
+def pixel_diff(image, reference):
+    '''
+    Compare two RGBA images, padding the smaller one with transparent pixels.
+    Returns the mean absolute difference from 0 to 1 and the fraction of pixels
+    that differ by more than 32 in any channel from every reference pixel within
+    DRIFT_PIXELS of them on the same row.
+    '''
+    height = max(image.height, reference.height)
+    width = max(image.width, reference.width)
+
+    arrays = []
+    for picture in (image, reference):
+        array = np.zeros((height, width, 4), dtype=np.int16)
+        array[:picture.height, :picture.width] = np.asarray(picture.convert("RGBA"))
+        arrays.append(array)
+
+    difference = np.abs(arrays[0] - arrays[1])
+
+    padded = np.pad(arrays[1], ((0, 0), (DRIFT_PIXELS, DRIFT_PIXELS), (0, 0)), mode="edge")
+    closest = np.min([np.abs(arrays[0] - padded[:, shift:shift + width]).max(axis=-1)
+                      for shift in range(2 * DRIFT_PIXELS + 1)], axis=0)
+
+    return difference.mean() / 255, (closest > 32).mean()
+
+
+def benchmark_cards(num_cards):
+    '''
+    Time the pillow card backend against the browser render pool on synthetic
+    posts and comments, and diff the two backends' cleaned cards pixel by pixel,
+    failing if any card differs by more than MAX_CARD_CHANGED. Without a browser
+    the diff is skipped and reported as not verified.
+    '''
+    posts = record_accumulate(synthetic_listing(num_cards))
+    comments = []
+    for post in posts:
+        # Keep the cards offline so only rendering is timed
+        post.awards = []
+        comments.append(Comment(body=post.body[:300], author=post.author, upvotes=post.upvotes,
+                                num_awards=0, id=post.id))
+
+    start = time.perf_counter()
+    for i in range(num_cards):
+        random.seed(i)
+        draw_post_card(posts[i])
+        draw_comment_card(comments[i])
+    pillow = (time.perf_counter() - start) / num_cards
+
+    print(f"{num_cards} post and comment cards")
+    print(f"  pillow: {pillow * 1000:.1f}ms per pair")
+
+    try:
+        pool = get_render_pool()
+    except Exception as e:
+        print(f"  html:   skipped, the render pool couldn't start ({e})")
+        print("  pixel difference: NOT VERIFIED, the pillow cards weren't compared to the browser")
+        return
+
+    start = time.perf_counter()
+    references = []
+    for i in range(num_cards):
+        random.seed(i)
+        for document in (format_post_document(posts[i]), format_comment_document(comments[i])):
+            references.append(trim_image(decode_screenshot(pool.render(document))))
+    chrome = (time.perf_counter() - start) / num_cards
+
+    differences = []
+    cards_drawn = []
+    for i in range(num_cards):
+        random.seed(i)
+        cards = (draw_post_card(posts[i]), draw_comment_card(comments[i]))
+        for card, reference in zip(cards, references[2 * i:2 * i + 2]):
+            differences.append(pixel_diff(card, Image.fromarray(reference)))
+            cards_drawn.append(np.asarray(card))
+
+    mean_difference = np.mean([difference[0] for difference in differences])
+    changed = np.median([difference[1] for difference in differences])
+    resized = sum(card.shape != reference.shape for card, reference in zip(cards_drawn, references))
+
+    worst = max(range(len(differences)), key=lambda i: differences[i][1])
+
+    print(f"  html:   {chrome * 1000:.1f}ms per pair ({chrome / pillow:.0f}x slower)")
+    print(f"  pixel difference: {mean_difference:.2%} mean, {changed:.1%} median of pixels off by more than 32")
+    print(f"  worst card: {differences[worst][1]:.1%} of pixels off by more than 32")
+    print(f"  different height: {resized} of {len(references)} cards")
+
+    if differences[worst][1] > MAX_CARD_CHANGED:
+        card = "post" if worst % 2 == 0 else "comment"
+        raise Exception(f"The pillow {card} card {worst // 2} has {differences[worst][1]:.1%} of its pixels "
+                        f"off from the browser render, more than {MAX_CARD_CHANGED:.0%}")
+
+
+def legacy_row_same(row):
+    '''
+    The original row check of clean_image, kept as a baseline.
+    '''
+    for i in range(1, len(row)):
+        if row[0] != row[i] and not row[i]:
+            return False
+
+    return True
+
+
+def legacy_col_same(array, index):
+    '''
+    The original column check of clean_image, kept as a baseline.
+    '''
+    for i in range(len(array)):
+        if array[i][0] != array[i][index]:
+            return False
+
+    return True
+
+
+def legacy_trim_image(image):
+    '''
+    The original row and column deletion loops of clean_image, kept as a baseline.
+    '''
+    image = image.copy()
+
+    idx = (image[...,:3] == np.array((0,0,0))).all(axis=-1)
+    image[idx,3] = 0
+
+    transparent_rows = []
+    for i, row in enumerate(idx):
+        if legacy_row_same(row):
+            transparent_rows.append(i)
+
+    idx = np.delete(idx, transparent_rows, 0)
+    image = np.delete(image, transparent_rows, 0)
+
+    transparent_rows.clear()
+    for i in range(len(idx[0])):
+        if legacy_col_same(idx, i):
+            transparent_rows.append(i)
+
+    return np.delete(image, transparent_rows, 1)
+
+
+def screenshot_of(card, size=(1920, 1080)):
+    '''
+    Place a cleaned card on a black background the way it appears in a raw
+    screenshot of its template, 8px in from the top left.
+    '''
+    card = np.asarray(Image.open(card).convert("RGBA"))
+    screenshot = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+    screenshot[..., 3] = 255
+
+    # The transparent corners of the card show the background through them
+    opaque = card[..., 3:] != 0
+    region = screenshot[8:8 + card.shape[0], 8:8 + card.shape[1]]
+    region[:] = np.where(opaque, card, region)
+
+    return screenshot
+
+
+def benchmark_crop():
+    '''
+    Time the original clean_image crop against trim_image on screenshots of the
+    example cards and check that they crop to the same image.
+    '''
+    for card in ["media/example_post.png", "media/example_comment.png"]:
+        screenshot = screenshot_of(card)
+
+        legacy, legacy_trimmed = time_call(legacy_trim_image, screenshot, repeat=1)
+        vectorized, trimmed = time_call(trim_image, screenshot)
+
+        same = legacy_trimmed.shape == trimmed.shape and (legacy_trimmed == trimmed).all()
+
+        print(f"{card} ({screenshot.shape[1]}x{screenshot.shape[0]} screenshot)")
+        print(f"  crop:       {legacy:.3f}s -> {vectorized:.4f}s ({legacy / vectorized:.0f}x)")
+        print(f"  same image: {same} ({trimmed.shape[1]}x{trimmed.shape[0]})")
+
+
+def legacy_format_ssml(text, speed=100):
+    '''
+    The original replace passes and newline deletion loop of format_ssml, kept as a baseline.
+    '''
+    prefix = "<speak><prosody rate=\"{}%\">".format(speed)
+    suffix = "</prosody></speak>"
+
+    text = text.replace("&", "&amp;")
+    text = text.replace("\"", "&quot;")
+    text = text.replace("'", "&apos;")
+    text = text.replace("<", "&lt;")
+    text = text.replace(">", "&gt;")
+
+    characters = [*text]
+    for i in range(len(characters) - 1, 0, -1):
+        if characters[i] == characters[i-1] == '\n':
+            del characters[i]
+
+    ssml = ("".join(characters)).replace('\n', "<break />")
+
+    return prefix + ssml + suffix
+
+
+def benchmark_ssml(num_texts):
+    '''
+    Check that format_ssml gives the same output as the original on random texts
+    full of reserved characters and newlines, failing on the first that differs, then time both on post bodies and
+    on a newline-heavy worst case.
+    '''
+    rng = random.Random(0)
+    alphabet = ["a", "b", " ", "\n", "\n\n", "&", "\"", "'", "<", ">", ";", "&amp;", "\r"]
+
+    texts = ["".join(rng.choices(alphabet, k=rng.randint(0, 200))) for _ in range(num_texts)]
+    speeds = [rng.randint(20, 200) for _ in texts]
+    for text, speed, ssml in zip(texts, speeds, format_ssml_batch(texts, speed=speeds)):
+        if legacy_format_ssml(text, speed) != ssml:
+            raise Exception(f"format_ssml differs from the original for {text!r} at speed {speed}")
+
+    bodies = [post['data']['selftext'] for post in synthetic_listing(num_texts)]
+    legacy_bodies, _ = time_call(lambda: [legacy_format_ssml(body) for body in bodies])
+    bodies_time, _ = time_call(format_ssml_batch, bodies)
+
+    newlines = "word\n\n\n\n" * 10000
+    legacy_newlines, _ = time_call(legacy_format_ssml, newlines, repeat=1)
+    newlines_time, _ = time_call(format_ssml, newlines)
+
+    print(f"{num_texts} random texts, same output as the original")
+    print(f"  post bodies:   {legacy_bodies:.3f}s -> {bodies_time:.3f}s ({legacy_bodies / bodies_time:.0f}x)")
+    print(f"  newline heavy: {legacy_newlines:.3f}s -> {newlines_time:.4f}s ({legacy_newlines / newlines_time:.0f}x)")
+
+
+def render_cost(backend, arguments, env=None):
+    '''
+    Render a video with a backend in a fresh interpreter, with extra environment
+    variables if given, and return how long it took in seconds along with the peak
+    RSS in MB of the interpreter and of its largest child process, ffmpeg (0 where
+    /proc isn't available).
+    '''
+    script = (f"from utilities.background_library import BackgroundVideo\n"
+              f"from utilities.video_creator import VIDEO_BACKENDS, voiceover_track\n"
+              f"from utilities.voiceover_creator import Voiceover\n"
+              f"import resource, os\n"
+              f"output, background, start_time, length, overlays, voiceovers = {arguments!r}\n"
+              f"audio, _ = voiceover_track([Voiceover(path, duration) for path, duration in voiceovers])\n"
+              f"VIDEO_BACKENDS[{backend!r}](output, BackgroundVideo(**background), start_time, length, "
+              f"overlays, audio)\n"
+              f"print(open('/proc/self/status').read() if os.path.exists('/proc/self/status') else '')\n"
+              f"print('Children', resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)\n")
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True,
+                            env=None if env is None else {**os.environ, **env}).stdout
+    elapsed = time.perf_counter() - start
+
+    peak = [line.split()[1] for line in output.splitlines() if line.startswith("VmHWM")]
+    children = [line.split()[1] for line in output.splitlines() if line.startswith("Children")]
+
+    return elapsed, int(peak[0]) / 1024 if peak else 0, int(children[0]) / 1024
+
+
+def video_frame(path, seconds, size=(1080, 1920)):
+    '''
+    Decode the frame of a video at a time into an RGB array.
+    '''
+    frame = subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-loglevel", "error", "-ss", str(seconds), "-i", path,
+                            "-frames:v", "1", "-f", "rawvideo", "-pix_fmt", "rgb24", "-"],
+                           check=True, capture_output=True).stdout
+
+    return np.frombuffer(frame, dtype=np.uint8).reshape(size[1], size[0], 3)
+
+
+def benchmark_video(seconds):
+    '''
+    Render the same reel with the moviepy and ffmpeg video backends over a synthetic
+    1080p background, using the example cards and tone voiceovers, then time them,
+    compare their peak memory and diff their frames during both cards.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        video_file = os.path.join(directory, "background.mp4")
+        subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-loglevel", "error", "-f", "lavfi", "-i",
+                        f"testsrc2=size=1920x1080:rate=30:duration={seconds}", "-c:v", "libx264",
+                        "-preset", "ultrafast", "-pix_fmt", "yuv420p", video_file], check=True)
+        background = probe_background(video_file)
+
+        # Voiceovers about a quarter and a fifth of the background's length
+        backend = ToneBackend()
+        voiceovers = []
+        for name, words in (("post", seconds // 4 * 3), ("comment", seconds // 5 * 3)):
+            audio, duration = backend.synthesize(format_ssml(" ".join(["word"] * words)))
+            path = os.path.join(directory, name + ".wav")
+            with open(path, "wb") as f:
+                f.write(audio)
+            voiceovers.append((path, duration))
+
+        post_end = voiceovers[0][1] + 1
+        length = post_end + voiceovers[1][1] + 1
+        overlays = [("media/example_post.png", 0, post_end), ("media/example_comment.png", post_end, length)]
+
+        outputs = {}
+        print(f"{length:.1f}s reel over a {seconds}s 1920x1080 background")
+        for name in VIDEO_BACKENDS:
+            outputs[name] = os.path.join(directory, name + ".mp4")
+            elapsed, rss, child_rss = render_cost(name, (outputs[name], asdict(background), 1, length, overlays,
+                                                         voiceovers))
+            print(f"  {name + ':':8} {elapsed:.1f}s, {rss:.0f}MB peak RSS, {child_rss:.0f}MB largest child RSS")
+
+        for label, time_point in (("post card", post_end / 2), ("comment card", (post_end + length) / 2)):
+            frames = [video_frame(output, time_point).astype(np.int16) for output in outputs.values()]
+            print(f"  {label} frame difference: {np.abs(frames[0] - frames[1]).mean() / 255:.2%} mean")
+
+
+def read_header(path):
+    '''
+    Open a video and read its header, the way VideoFileClip did for every reel.
+    '''
+    reader = imageio_ffmpeg.read_frames(path)
+    meta = next(reader)
+    reader.close()
+
+    return meta
+
+
+def first_frame_time(path, start_time):
+    '''
+    Return how long ffmpeg takes to seek a video to a time and decode the frame there.
+    '''
+    start = time.perf_counter()
+    subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-loglevel", "error", "-ss", str(start_time), "-i", path,
+                    "-frames:v", "1", "-f", "null", "-"], check=True)
+
+    return time.perf_counter() - start
+
+
+def benchmark_library(num_videos):
+    '''
+    Build a background library index over synthetic 1080p videos with 10 second GOPs,
+    then compare choosing clips from the index against opening a video for every
+    reel, and decoding from a snapped start time against an arbitrary one.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(num_videos):
+            subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-loglevel", "error", "-f", "lavfi", "-i",
+                            f"testsrc2=size=1920x1080:rate=30:duration={30 * (i + 1)}", "-c:v", "libx264",
+                            "-preset", "ultrafast", "-g", "300", "-pix_fmt", "yuv420p",
+                            os.path.join(directory, f"background{i}.mp4")], check=True)
+
+        library = BackgroundLibrary(directory)
+        cold, videos = time_call(library.refresh, repeat=1)
+        warm, _ = time_call(lambda: [library.choose(20) for _ in range(100)])
+
+        opened, _ = time_call(lambda: [read_header(video.path) for video in videos.values()])
+
+        rng = random.Random(0)
+        starts = [rng.random() * (video.duration - 20) for video in videos.values() for _ in range(3)]
+        paths = [video.path for video in videos.values() for _ in range(3)]
+        arbitrary = sum(first_frame_time(path, start) for path, start in zip(paths, starts))
+        snapped = sum(first_frame_time(path, videos[os.path.basename(path)].keyframe_before(start))
+                      for path, start in zip(paths, starts))
+
+        try:
+            library.choose(30 * num_videos + 1)
+            too_long = "chosen"
+        except Exception:
+            too_long = "refused"
+
+        print(f"{num_videos} background videos, index {os.path.getsize(os.path.join(directory, INDEX_NAME))} bytes")
+        print(f"  building the index:       {cold:.2f}s")
+        print(f"  opening a video per reel: {opened / num_videos * 1000:.0f}ms")
+        print(f"  choosing from the index:  {warm / 100 * 1000:.2f}ms")
+        print(f"  first frame: {arbitrary / len(starts) * 1000:.0f}ms from any time -> "
+              f"{snapped / len(starts) * 1000:.0f}ms from a keyframe")
+        print(f"  clip longer than every video: {too_long}")
+
+
+def background_time(background, start_time, length):
+    '''
+    Return how long ffmpeg takes to decode a stretch of a background and bring it to the
+    output size, the part of a render that a proxy saves, without encoding anything.
+    '''
+    x1, x2 = crop_box((background.width, background.height))
+    scale = "null" if (background.width, background.height) == OUTPUT_SIZE else f"crop={x2 - x1}:ih:{x1}:0,scale=1080:1920"
+    start = time.perf_counter()
+    subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-loglevel", "error", "-ss", str(start_time), "-t", str(length),
+                    "-i", background.path, "-vf", scale, "-f", "null", "-"], check=True)
+
+    return time.perf_counter() - start
+
+
+def benchmark_proxy(seconds, size="3840x2160"):
+    '''
+    Render the same reel with the ffmpeg backend from a synthetic background (4K by
+    default) and from its proxy, then compare the time, disk usage and frames of the two.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-loglevel", "error", "-f", "lavfi", "-i",
+                        f"testsrc2=size={size}:rate=30:duration={seconds}", "-c:v", "libx264",
+                        "-preset", "ultrafast", "-g", "300", "-pix_fmt", "yuv420p",
+                        os.path.join(directory, "background.mp4")], check=True)
+
+        library = BackgroundLibrary(directory)
+        building, _ = time_call(library.build_proxies, repeat=1)
+        video = library.refresh()["background.mp4"]
+
+        audio, duration = ToneBackend().synthesize(format_ssml(" ".join(["word"] * (seconds // 2))))
+        path = os.path.join(directory, "post.wav")
+        with open(path, "wb") as f:
+            f.write(audio)
+        length = duration + 1
+        overlays = [("media/example_post.png", 0, length)]
+
+        # Start on a keyframe of both the source and the proxy
+        start_time = video.keyframes[1]
+        outputs = {}
+        print(f"{length:.1f}s reel over a {seconds}s {size} background, proxy built in {building:.1f}s")
+        for name, background in (("source", video), ("proxy", video.proxy)):
+            outputs[name] = os.path.join(directory, name + ".mp4")
+            elapsed, rss, child_rss = render_cost("ffmpeg", (outputs[name], asdict(background), start_time, length,
+                                                             overlays, [(path, duration)]))
+            decoding = background_time(background, start_time, length)
+            print(f"  {name + ':':7} {elapsed:.1f}s render, {decoding:.2f}s of it decoding and scaling, "
+                  f"{background.size / 1e6:.1f}MB on disk, {child_rss:.0f}MB ffmpeg peak RSS")
+
+        frames = [video_frame(output, length / 2).astype(np.int16) for output in outputs.values()]
+        print(f"  frame difference: {np.abs(frames[0] - frames[1]).mean() / 255:.2%} mean")
+
+
+def gray_frames(path):
+    '''
+    Decode every frame of a video, shrunk to a tenth of its size in grayscale.
+    '''
+    frames = subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-loglevel", "error", "-i", path, "-vf", "scale=108:192",
+                             "-f", "rawvideo", "-pix_fmt", "gray", "-"], check=True, capture_output=True).stdout
+
+    return np.frombuffer(frames, dtype=np.uint8).reshape(-1, 192, 108).astype(np.int16)
+
+
+def benchmark_parallel(seconds):
+    '''
+    Render the same reel over a synthetic 1080p background in one ffmpeg process and
+    in segments across 2, 4 and every core's worth of workers. Each parallel render is
+    timed and checked frame by frame against the single render for seams and drift.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        video_file = os.path.join(directory, "background.mp4")
+        subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-loglevel", "error", "-f", "lavfi", "-i",
+                        f"testsrc2=size=1920x1080:rate=30:duration={seconds}", "-c:v", "libx264",
+                        "-preset", "ultrafast", "-g", "30", "-pix_fmt", "yuv420p", video_file], check=True)
+        background = asdict(probe_background(video_file))
+
+        audio, duration = ToneBackend().synthesize(format_ssml(" ".join(["word"] * (seconds // 2))))
+        path = os.path.join(directory, "post.wav")
+        with open(path, "wb") as f:
+            f.write(audio)
+        length = duration + 1
+        overlays = [("media/example_post.png", 0, length / 2), ("media/example_comment.png", length / 2, length)]
+
+        single = os.path.join(directory, "single.mp4")
+        elapsed, _, _ = render_cost("ffmpeg", (single, background, 1, length, overlays, [(path, duration)]))
+        reference = gray_frames(single)
+        print(f"{length:.1f}s reel over a {seconds}s 1920x1080 background, {os.cpu_count()} cores")
+        print(f"  1 process: {elapsed:.1f}s, {len(reference)} frames")
+
+        for workers in sorted({2, 4, os.cpu_count() or 1} - {1}):
+            output = os.path.join(directory, f"parallel{workers}.mp4")
+            parallel, _, _ = render_cost("parallel", (output, background, 1, length, overlays, [(path, duration)]),
+                                            env={'RENDER_WORKERS': str(workers)})
+            frames = gray_frames(output)
+            if len(frames) != len(reference):
+                raise Exception(f"{workers} workers rendered {len(frames)} frames instead of {len(reference)}")
+            count = len(reference)
+            worst = np.abs(frames[:count] - reference[:count]).mean(axis=(1, 2)).max()
+            print(f"  {workers} workers: {parallel:.1f}s ({elapsed / parallel:.2f}x), {len(frames)} frames, "
+                  f"worst frame differs by {worst:.2f} of 255")
+
+
+def legacy_voiceover_track(paths, directory):
+    '''
+    The original audio assembly: write a second of silence to silence.mp3 with moviepy,
+    decode it again along with the voiceovers and concatenate the clips.
+    '''
+    from moviepy.editor import AudioClip, AudioFileClip, concatenate_audioclips
+
+    make_frame = lambda t: 2*[ 0 * t ]
+    AudioClip(make_frame, duration=1).set_fps(24000).write_audiofile(os.path.join(directory, "silence.mp3"),
+                                                                      verbose=False, logger=None)
+    silence = AudioFileClip(os.path.join(directory, "silence.mp3"))
+    voiceover = concatenate_audioclips([AudioFileClip(paths[0]), silence, AudioFileClip(paths[1])])
+
+    # write_videofile decodes the whole track in chunks like this to encode it
+    return np.vstack(list(voiceover.iter_chunks(fps=44100, quantize=True, nbytes=2, chunksize=2000)))
+
+
+def benchmark_audio(seconds):
+    '''
+    Time assembling a post and comment voiceover track in memory against the original
+    silence.mp3 round trip through moviepy, and compare where the comment starts by the
+    mp3 header durations the overlays used to be scheduled by and by the decoded samples.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        backend = ToneBackend()
+        voiceovers = []
+        for name, words in (("post", seconds * 2), ("comment", seconds)):
+            audio, _ = backend.synthesize(format_ssml(" ".join(["word"] * words)))
+            with open(os.path.join(directory, name + ".wav"), "wb") as f:
+                f.write(audio)
+            # Encode it like the Polly voiceovers used to be
+            path = os.path.join(directory, name + ".mp3")
+            subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-loglevel", "error", "-i",
+                            os.path.join(directory, name + ".wav"), "-b:a", "48k", path], check=True)
+            with open(path, "rb") as f:
+                voiceovers.append(Voiceover(path, mp3_duration(f.read())))
+
+        in_memory, (track, timings) = time_call(voiceover_track, voiceovers)
+
+        # The first sound of the comment should be right where its timing says it starts
+        first = timings[1][0] + np.flatnonzero(track[round(timings[1][0] * TRACK_RATE):] != 0)[0] / TRACK_RATE
+
+        print(f"{len(track) / TRACK_RATE:.1f}s post and comment track")
+        print(f"  in memory: {in_memory * 1000:.0f}ms")
+        try:
+            legacy, _ = time_call(legacy_voiceover_track, [voiceover.path for voiceover in voiceovers], directory)
+            print(f"  silence.mp3 and moviepy: {legacy * 1000:.0f}ms ({legacy / in_memory:.1f}x)")
+        except ImportError:
+            print("  silence.mp3 and moviepy: skipped, moviepy isn't installed")
+        print(f"  comment starts at {voiceovers[0].duration + 1:.3f}s by mp3 headers, {timings[1][0]:.3f}s by samples, "
+              f"first sound at {first:.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='Content Generation Benchmarks',
+                                     description='Time pipeline stages against their previous implementations')
+    parser.add_argument('benchmark', type=str, choices=['rank', 'records', 'cards', 'crop', 'ssml', 'video', 'library', 'proxy', 'parallel', 'audio'],
+                        help='The benchmark to run.')
+    parser.add_argument('-n', '--num', type=int, default=10000,
+                        help='The number of synthetic items to use.', required=False)
+    parser.add_argument('-b', '--bounds', type=str, default="8,121",
+                        help='Wordcount bounds formatted lb,ub.', required=False)
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'rank':
+        benchmark_ranking(args.num, args.bounds)
+    elif args.benchmark == 'records':
+        benchmark_records(args.num)
+    elif args.benchmark == 'cards':
+        benchmark_cards(min(args.num, 100))
+    elif args.benchmark == 'crop':
+        benchmark_crop()
+    elif args.benchmark == 'ssml':
+        benchmark_ssml(args.num)
+    elif args.benchmark == 'video':
+        benchmark_video(min(args.num, 60))
+    elif args.benchmark == 'library':
+        benchmark_library(min(args.num, 5))
+    elif args.benchmark == 'proxy':
+        benchmark_proxy(min(args.num, 60))
+    elif args.benchmark == 'parallel':
+        benchmark_parallel(min(args.num, 60))
+    elif args.benchmark == 'audio':
+        benchmark_audio(min(args.num, 60))
@@ -1,4 +1,4 @@
-from utilities.post_collector import get_top_post
+from utilities.post_collector import get_top_k_posts
 from utilities.comment_collector import get_top_comment
 from utilities.image_creator import create_image
 from utilities.voiceover_creator import create_voiceover
@@ -10,20 +10,42 @@ import argparse
 import os
 
 
-def cleanup(post_name, comment=False):
+def cleanup(voiceovers):
     '''
-    Given a post name, clean up the unneseccary png and mp3 files.
+    Given the voiceovers of a post, clean up the unneseccary audio files.
     '''
-    save_dir = os.getenv('SAVE_PATH')
+    for voiceover in voiceovers:
+        os.remove(voiceover.path)
 
-    os.remove(os.path.join(save_dir, post_name + ".png"))
-    os.remove(os.path.join(save_dir, post_name + ".mp3"))
-    
-    # Do the same for the comment files if they were created
-    if comment:
-        os.remove(os.path.join(save_dir, post_name + "_comment" + ".png"))
-        os.remove(os.path.join(save_dir, post_name + "_comment" + ".mp3"))
-        os.remove(os.path.join(save_dir, "silence.mp3"))
+
+def create_reel(post, post_name, wordcount_bounds, headers, fetch_comment, upload, anonymize, renderer=None):
+    '''
+    Given a post, fetch its comment if asked to, then create the reel and upload it if asked to.
+    '''
+    comment = get_top_comment(post, wordcount_bounds, headers=headers) if fetch_comment else False
+
+    # If you were trying to fetch a comment but couldn't, set fetch_comment to false
+    if not fetch_comment or (fetch_comment and type(comment) == bool and not comment):
+        fetch_comment = False
+        comment = None
+
+    # If anonymize is passed, anonymize the user(s)
+    if anonymize:
+        post['author'] = "AnonymousUser"
+        if comment is not None:
+            comment['author'] = "AnonymousUser"
+            comment['avatar'] = "https://www.redditstatic.com/avatars/avatar_default_02_A5A4A4.png"
+
+    post_image, comment_image = create_image(post, post_name, comment=comment, backend=renderer)
+
+    voiceovers = create_voiceover(post, post_name, comment=comment)
+
+    create_video(post_name, post_image, comment_image=comment_image, voiceovers=voiceovers)
+
+    cleanup(voiceovers)
+
+    if upload:
+        post_reel(post_name, post)
 
 
 def create_post():
@@ -47,6 +69,12 @@ def create_post():
                         help='Whether or not to upload the post to Instagram.')
     parser.add_argument('-a', '--anonymize', action='store_true', required=False,
                         help='Whether or not to anonymize the user(s) scraped.')
+    parser.add_argument('-g', '--group', type=int, default=1, required=False,
+                        help='Fetch this many subreddits per combined listing request.')
+    parser.add_argument('-k', '--count', type=int, default=1, required=False,
+                        help='How many reels to make from the best posts of one scrape.')
+    parser.add_argument('-r', '--renderer', type=str, choices=['html', 'pillow'], default=None, required=False,
+                        help='How to render the post and comment cards. Defaults to RENDER_BACKEND in .env, or html.')
     
     args = parser.parse_args()
     subreddits = args.subreddits
@@ -55,6 +83,9 @@ def create_post():
     fetch_comment = args.comment
     upload = args.upload
     anonymize = args.anonymize
+    group_size = args.group
+    count = args.count
+    renderer = args.renderer
 
     load_dotenv()
     save_dir = os.getenv('SAVE_PATH')
@@ -63,31 +94,17 @@ def create_post():
     if post_name is None:
         post_name = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
-    post, headers = get_top_post(subreddits, wordcount_bounds)
-    comment = get_top_comment(post, wordcount_bounds, headers=headers)
-
-    # If you were trying to fetch a comment but couldn't, set fetch_comment to false
-    if not fetch_comment or (fetch_comment and type(comment) == bool and not comment):
-        fetch_comment = False
-        comment = None
-
-    # If anonymize is passed, anonymize the user(s)
-    if anonymize:
-        post['author'] = "AnonymousUser"
-        if comment is not None:
-            comment['author'] = "AnonymousUser"
-            comment['avatar'] = "https://www.redditstatic.com/avatars/avatar_default_02_A5A4A4.png"
-
-    create_image(post, post_name, comment=comment)
-
-    create_voiceover(post, post_name, comment=comment)
-
-    create_video(post_name, comment=fetch_comment)
+    posts, headers = get_top_k_posts(subreddits, wordcount_bounds, k=count, group_size=group_size)
 
-    cleanup(post_name, comment=fetch_comment)
+    # If no post is found, throw an exception and terminate
+    if len(posts) == 0:
+        raise Exception("No posts could be found")
 
-    if upload:
-        post_reel(post_name, post)
+    for i in range(len(posts)):
+        post = posts[i].copy()
+        # Number the reels if more than one is being made
+        name = post_name if count == 1 else f"{post_name}_{i + 1}"
+        create_reel(post, name, wordcount_bounds, headers, fetch_comment, upload, anonymize, renderer)
 
     print("Done.")
 
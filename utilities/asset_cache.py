@@ -0,0 +1,203 @@
+from utilities.file_lock import atomic_write
+from dotenv import load_dotenv
+import threading
+import requests
+import hashlib
+import sqlite3
+import json
+import time
+import html
+import os
+
+
+# Default size limit of the cache in bytes
+MAX_BYTES = 256 * 1024 * 1024
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class AssetCache:
+    '''
+    A local content-addressed cache of binary assets with size-bounded LRU eviction.
+
+    Entries are looked up by key (a url, for example) and point to a blob named after
+    the sha256 of its contents, so identical assets are only stored once. Each entry
+    can carry a small JSON dictionary of metadata. Once the blobs take up more than
+    max_bytes the least recently used entries are evicted, and entries older than
+    max_age seconds (if given) are treated as missing.
+    '''
+    def __init__(self, directory, max_bytes=MAX_BYTES, max_age=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                metadata TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at);
+        ''')
+
+    def blob_path(self, digest):
+        '''
+        Return the path a blob is stored at.
+        '''
+        return os.path.join(self.directory, "blobs", digest[:2], digest)
+
+    def lookup(self, key):
+        '''
+        Return the digest and metadata of a fresh entry and mark it as used,
+        or None if there isn't one.
+        '''
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT digest, metadata, created_at FROM entries WHERE key = ?",
+                                          (key,)).fetchone()
+            if row is None or (self.max_age is not None and row[2] + self.max_age < now):
+                return None
+            self.connection.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+
+        return row[0], json.loads(row[1])
+
+    def get_with_metadata(self, key):
+        '''
+        Return the contents and metadata of an entry, or (None, None) if it isn't cached.
+        '''
+        entry = self.lookup(key)
+        if entry is None:
+            return None, None
+
+        try:
+            with open(self.blob_path(entry[0]), "rb") as f:
+                return f.read(), entry[1]
+        except OSError:
+            return None, None
+
+    def get(self, key):
+        '''
+        Return the contents of an entry, or None if it isn't cached.
+        '''
+        return self.get_with_metadata(key)[0]
+
+    def get_metadata(self, key):
+        '''
+        Return the metadata of an entry, or None if it isn't cached.
+        '''
+        entry = self.lookup(key)
+
+        return None if entry is None else entry[1]
+
+    def put(self, key, data, metadata=None):
+        '''
+        Save the contents of an entry along with its metadata, then evict
+        entries until the cache fits in its size limit.
+        '''
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write(path, data)
+
+        now = time.time()
+        with self.lock, self.connection:
+            previous = self.connection.execute("SELECT digest FROM entries WHERE key = ?", (key,)).fetchone()
+            self.connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                                    (key, digest, len(data), json.dumps(metadata or {}), now, now))
+        self.evict([] if previous is None else [previous[0]])
+
+        return digest
+
+    def evict(self, replaced=()):
+        '''
+        Delete expired entries, then the least recently used ones until the blobs
+        fit in max_bytes. Blobs no longer used by any entry (including the digests
+        of replaced entries) are removed from disk.
+        '''
+        removed = set(replaced)
+        with self.lock, self.connection:
+            if self.max_age is not None:
+                cutoff = time.time() - self.max_age
+                removed.update(row[0] for row in self.connection.execute(
+                    "SELECT digest FROM entries WHERE created_at < ?", (cutoff,)))
+                self.connection.execute("DELETE FROM entries WHERE created_at < ?", (cutoff,))
+
+            total = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM entries)").fetchone()[0]
+            if total > self.max_bytes:
+                for key, digest, size in self.connection.execute(
+                        "SELECT key, digest, size FROM entries ORDER BY accessed_at").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    removed.add(digest)
+                    # The blob only frees space once no other entry shares it
+                    if self.connection.execute("SELECT 1 FROM entries WHERE digest = ?", (digest,)).fetchone() is None:
+                        total -= size
+
+            unused = [digest for digest in removed if self.connection.execute(
+                "SELECT 1 FROM entries WHERE digest = ?", (digest,)).fetchone() is None]
+
+        for digest in unused:
+            try:
+                os.remove(self.blob_path(digest))
+            except OSError:
+                pass
+
+    def fetch(self, url):
+        '''
+        Return the contents of a url and its content type, downloading it only if it
+        isn't cached. Returns (None, None) if it can't be downloaded.
+        '''
+        url = html.unescape(url)
+        data, metadata = self.get_with_metadata(url)
+        if data is not None:
+            return data, metadata.get('content_type')
+
+        try:
+            r = requests.get(url, timeout=10)
+        except requests.RequestException as e:
+            print(e)
+            return None, None
+
+        if r.status_code != 200:
+            print(r)
+            return None, None
+
+        content_type = r.headers.get('Content-Type', 'application/octet-stream').split(";")[0]
+        self.put(url, r.content, {'content_type': content_type})
+
+        return r.content, content_type
+
+    def close(self):
+        '''
+        Close the index database.
+        '''
+        with self.lock:
+            self.connection.close()
+
+
+def get_asset_cache():
+    '''
+    Return the asset cache shared by everything in the process, opening it on first use.
+    The folder is set by ASSET_CACHE in .env and defaults to asset_cache, and
+    ASSET_CACHE_SIZE optionally sets its size limit in MB.
+    '''
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            load_dotenv()
+            _cache = AssetCache(os.getenv("ASSET_CACHE", "asset_cache"),
+                                max_bytes=float(os.getenv("ASSET_CACHE_SIZE", MAX_BYTES / 1024 / 1024)) * 1024 * 1024)
+
+    return _cache
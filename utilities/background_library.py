@@ -0,0 +1,418 @@
+from utilities.file_lock import FileLock, atomic_path, atomic_write
+from dataclasses import dataclass, field, asdict
+from fractions import Fraction
+from dotenv import load_dotenv
+import imageio_ffmpeg
+import subprocess
+import threading
+import random
+import bisect
+import shutil
+import argparse
+import json
+import math
+import re
+import os
+
+
+# Name of the index file kept in the background video folder
+INDEX_NAME = "background_index.json"
+# Bumped when the fields of an entry change, so indexes written by older versions are rebuilt
+INDEX_VERSION = 1
+# Folder next to the index that pre-cropped proxies of the backgrounds are kept in
+PROXY_FOLDER = "proxies"
+# Size of the finished video and of the proxies, portrait 9:16 for reels
+OUTPUT_SIZE = (1080, 1920)
+# Seconds between keyframes in a proxy, so any start time is at most this far from one
+PROXY_GOP_SECONDS = 1
+# x264 quality and speed of the proxies, which are only encoded once
+PROXY_CRF = 18
+PROXY_PRESET = "veryfast"
+
+_libraries = {}
+_libraries_lock = threading.Lock()
+
+
+@dataclass
+class BackgroundVideo:
+    '''
+    A background video along with everything create_video needs to know about it,
+    so it never has to be opened just to be chosen. mtime and size identify the
+    version of the file the entry describes. Files that can't be read as video
+    are kept with a duration of 0 so they aren't probed again until they change.
+    proxy is the pre-cropped copy of the video made by build_proxies, if there is one.
+    '''
+    path: str
+    mtime: float
+    size: int
+    duration: float = 0
+    width: int = 0
+    height: int = 0
+    fps: float = 0
+    codec: str = ""
+    keyframes: list = field(default_factory=list)
+    proxy: "BackgroundVideo" = None
+
+    def keyframe_before(self, time):
+        '''
+        Return the time of the last keyframe at or before a time, or the time itself
+        if there isn't one, so decoding from it doesn't have to skip any frames.
+        '''
+        i = bisect.bisect_right(self.keyframes, time)
+
+        return self.keyframes[i - 1] if i > 0 else time
+
+
+def crop_box(size):
+    '''
+    Given the size of a background video, return the (x1, x2) columns of the
+    centered 9:16 crop that fills its full height.
+    '''
+    x, y = size
+    width = y * (9/16)
+    if width % 2 == 1:
+        width += 1
+    x1 = math.floor((x / 2) - (width / 2))
+    x2 = math.ceil((x / 2) + (width / 2))
+
+    return x1, x2
+
+
+def probe_ffprobe(ffprobe, path):
+    '''
+    Read the stream details and keyframe times of a video with ffprobe.
+    Keyframes come from the packet flags, so nothing is decoded.
+    '''
+    details = json.loads(subprocess.run(
+        [ffprobe, "-v", "error", "-select_streams", "v:0", "-of", "json",
+         "-show_entries", "stream=codec_name,width,height,avg_frame_rate:format=duration", path],
+        check=True, capture_output=True, text=True).stdout)
+    stream = details['streams'][0]
+    rate = stream.get('avg_frame_rate', "0/0")
+
+    # Each line is pts_time,dts_time,flags
+    packets = subprocess.run(
+        [ffprobe, "-v", "error", "-select_streams", "v:0", "-of", "csv=p=0",
+         "-show_entries", "packet=pts_time,dts_time,flags", path],
+        check=True, capture_output=True, text=True).stdout
+
+    keyframes = []
+    for line in packets.splitlines():
+        fields = line.split(",")
+        if len(fields) == 3 and "K" in fields[2]:
+            time = fields[0] if fields[0] != "N/A" else fields[1]
+            if time != "N/A":
+                keyframes.append(float(time))
+
+    return {
+        'duration': float(details['format']['duration']),
+        'width': int(stream['width']),
+        'height': int(stream['height']),
+        'fps': float(Fraction(rate)) if rate != "0/0" else 0,
+        'codec': stream['codec_name'],
+        'keyframes': sorted(keyframes),
+    }
+
+
+def probe_ffmpeg(path):
+    '''
+    Read the stream details and keyframe times of a video with the ffmpeg binary alone,
+    for when ffprobe isn't installed. The details are parsed from the file's header and
+    the keyframe times from decoding only the keyframes.
+    '''
+    reader = imageio_ffmpeg.read_frames(path)
+    try:
+        meta = next(reader)
+    finally:
+        reader.close()
+
+    output = subprocess.run(
+        [imageio_ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-nostats", "-skip_frame", "nokey", "-i", path,
+         "-map", "0:v:0", "-vf", "showinfo", "-f", "null", "-"],
+        check=True, capture_output=True, text=True).stderr
+
+    return {
+        'duration': meta['duration'],
+        'width': meta['size'][0],
+        'height': meta['size'][1],
+        'fps': meta['fps'],
+        'codec': meta['codec'],
+        'keyframes': sorted(float(time) for time in re.findall(r"pts_time:\s*([\d.]+)", output)),
+    }
+
+
+def probe_background(path):
+    '''
+    Probe a video file and return a BackgroundVideo for it,
+    using ffprobe if it's installed and ffmpeg otherwise.
+    '''
+    stat = os.stat(path)
+    video = BackgroundVideo(path, stat.st_mtime, stat.st_size)
+
+    ffprobe = shutil.which("ffprobe")
+    try:
+        details = probe_ffprobe(ffprobe, path) if ffprobe is not None else probe_ffmpeg(path)
+    except Exception as e:
+        print(f"Couldn't read {path} as a video: {e}")
+        return video
+
+    for key, value in details.items():
+        setattr(video, key, value)
+
+    return video
+
+
+def create_proxy(video, path):
+    '''
+    Crop a background video to 9:16 and scale it to the output size once, encoding it
+    with a keyframe every PROXY_GOP_SECONDS so a render from any start time decodes
+    almost nothing it doesn't use. The audio is dropped since it's never used.
+    '''
+    x1, x2 = crop_box((video.width, video.height))
+    gop = max(1, round((video.fps or 30) * PROXY_GOP_SECONDS))
+
+    # Write to a temporary file first so a half written proxy is never used
+    with atomic_path(path) as temp_path:
+        command = [imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error", "-i", video.path, "-map", "0:v:0", "-an",
+                   "-vf", f"crop={x2 - x1}:ih:{x1}:0,scale={OUTPUT_SIZE[0]}:{OUTPUT_SIZE[1]},setsar=1",
+                   "-c:v", "libx264", "-preset", PROXY_PRESET, "-crf", str(PROXY_CRF), "-pix_fmt", "yuv420p",
+                   "-g", str(gop), "-keyint_min", str(gop), "-sc_threshold", "0",
+                   "-movflags", "+faststart", "-f", "mp4", temp_path]
+
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise Exception(f"ffmpeg failed to create a proxy of {video.path}: {result.stderr.decode(errors='replace')}")
+
+
+def format_size(size):
+    '''
+    Format a number of bytes in MB, or in GB once it's big enough.
+    '''
+    return f"{size / 1e9:.2f}GB" if size >= 1e9 else f"{size / 1e6:.1f}MB"
+
+
+def folder_size(folder):
+    '''
+    Return the total size in bytes of the files directly inside a folder.
+    '''
+    if not os.path.isdir(folder):
+        return 0
+
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+
+class BackgroundLibrary:
+    '''
+    An index of the background videos in a folder, kept in a JSON file inside it.
+
+    Each video is probed once for its duration, resolution, fps, codec and keyframe
+    times. An entry is reused until the file's mtime or size changes, and files that
+    are removed are dropped from the index. Clips are chosen from the index alone.
+    '''
+    def __init__(self, folder):
+        self.folder = folder
+        self.index_path = os.path.join(folder, INDEX_NAME)
+        self.videos = {}
+        self.loaded_mtime = None
+        self.lock = threading.Lock()
+
+    def read_index(self):
+        '''
+        Read the index from disk, returning an empty one if it's missing, unreadable or outdated.
+        '''
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(index, dict) or index.get('version') != INDEX_VERSION:
+            return {}
+
+        videos = {}
+        for name, entry in index.get('videos', {}).items():
+            proxy = entry.pop('proxy', None)
+            videos[name] = BackgroundVideo(os.path.join(self.folder, name), **entry)
+            if proxy is not None:
+                videos[name].proxy = BackgroundVideo(self.proxy_path(name), **proxy)
+
+        return videos
+
+    def write_index(self, videos):
+        '''
+        Write the index to disk atomically so other processes never read half of it.
+        '''
+        entries = {}
+        for name, video in videos.items():
+            entries[name] = asdict(video)
+            del entries[name]['path']
+            # The proxy's path always follows from the video's name
+            if video.proxy is not None:
+                del entries[name]['proxy']['path']
+                del entries[name]['proxy']['proxy']
+
+        atomic_write(self.index_path, json.dumps({'version': INDEX_VERSION, 'videos': entries}))
+
+    def list_files(self):
+        '''
+        Return the (mtime, size) of every file in the folder that could be a background video.
+        '''
+        files = {}
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and not entry.name.startswith(".") and not entry.name.startswith(INDEX_NAME):
+                stat = entry.stat()
+                files[entry.name] = (stat.st_mtime, stat.st_size)
+
+        return files
+
+    def index_mtime(self):
+        '''
+        Return the modification time of the index file, or None if it doesn't exist yet.
+        '''
+        try:
+            return os.path.getmtime(self.index_path)
+        except OSError:
+            return None
+
+    def refresh(self):
+        '''
+        Bring the index up to date with the folder, probing only the files that are new
+        or have changed since they were indexed. Returns the indexed videos by file name.
+        '''
+        with self.lock:
+            # Pick up anything another process wrote, like new proxies
+            mtime = self.index_mtime()
+            if mtime != self.loaded_mtime:
+                self.videos = self.read_index()
+                self.loaded_mtime = mtime
+
+            files = self.list_files()
+            stale = [name for name, (mtime, size) in files.items() if name not in self.videos or
+                     (self.videos[name].mtime, self.videos[name].size) != (mtime, size)]
+            removed = [name for name in self.videos if name not in files]
+
+            if not stale and not removed:
+                return dict(self.videos)
+
+            # Probe without holding the file lock, since it can take a while
+            probed = {name: probe_background(os.path.join(self.folder, name)) for name in stale}
+
+            with FileLock(self.index_path + ".lock"):
+                # Keep anything another process indexed in the meantime
+                videos = self.read_index()
+                videos.update(probed)
+                self.videos = {name: video for name, video in videos.items() if name in files}
+                self.write_index(self.videos)
+                self.loaded_mtime = self.index_mtime()
+
+            return dict(self.videos)
+
+    def proxy_path(self, name):
+        '''
+        Return the path the proxy of a video is stored at.
+        '''
+        return os.path.join(self.folder, PROXY_FOLDER, name + ".mp4")
+
+    def has_proxy(self, video):
+        '''
+        Return True if a video has a proxy and it's still on disk.
+        '''
+        try:
+            return video.proxy is not None and os.path.getsize(video.proxy.path) == video.proxy.size
+        except OSError:
+            return False
+
+    def save_proxy(self, name, video, proxy):
+        '''
+        Record the proxy of a video in the index, as long as the video hasn't changed since.
+        '''
+        with self.lock, FileLock(self.index_path + ".lock"):
+            videos = self.read_index()
+            current = videos.get(name)
+            if current is not None and (current.mtime, current.size) == (video.mtime, video.size):
+                current.proxy = proxy
+                self.write_index(videos)
+            self.videos = videos
+            self.loaded_mtime = self.index_mtime()
+
+    def build_proxies(self, force=False):
+        '''
+        Create a proxy of every indexed video that doesn't have an up to date one
+        (or of every video if force is True), delete proxies of videos that are gone
+        and print how much disk space the videos and proxies take up.
+        '''
+        videos = self.refresh()
+        os.makedirs(os.path.join(self.folder, PROXY_FOLDER), exist_ok=True)
+
+        for name, video in sorted(videos.items()):
+            if video.duration == 0 or (self.has_proxy(video) and not force):
+                continue
+
+            print(f"Creating a proxy of {name} ({video.duration:.0f}s {video.width}x{video.height})")
+            path = self.proxy_path(name)
+            create_proxy(video, path)
+            self.save_proxy(name, video, probe_background(path))
+
+        # Proxies of videos that were removed or replaced are no longer used
+        videos = self.refresh()
+        used = {os.path.basename(video.proxy.path) for video in videos.values() if self.has_proxy(video)}
+        for entry in os.scandir(os.path.join(self.folder, PROXY_FOLDER)):
+            if entry.is_file() and entry.name not in used:
+                os.remove(entry.path)
+
+        sources = sum(video.size for video in videos.values())
+        proxies = folder_size(os.path.join(self.folder, PROXY_FOLDER))
+        free = shutil.disk_usage(self.folder).free
+        print(f"{len(used)} of {len(videos)} videos have proxies")
+        print(f"Disk usage: {format_size(sources)} of videos, {format_size(proxies)} of proxies, {format_size(free)} free")
+
+    def choose(self, length):
+        '''
+        Choose a random background video at least length seconds long and a random
+        start time in it, snapped back to a keyframe. The video's proxy is returned
+        in its place if it has one. Returns (video, start time).
+        '''
+        sources = [video.proxy if self.has_proxy(video) else video for video in self.refresh().values()]
+        candidates = [video for video in sources if video.duration >= length]
+        if not candidates:
+            raise Exception(f"No background video in {self.folder} is at least {length:.1f} seconds long")
+
+        video = random.choice(candidates)
+        start_time = video.keyframe_before(random.random() * (video.duration - length))
+
+        return video, start_time
+
+
+def get_background_library(folder=None):
+    '''
+    Return the library of a background video folder, which defaults to
+    BACKGROUND_VIDEO_DIR in .env, creating it on first use.
+    '''
+    load_dotenv()
+    folder = folder or os.getenv('BACKGROUND_VIDEO_DIR')
+
+    with _libraries_lock:
+        if folder not in _libraries:
+            _libraries[folder] = BackgroundLibrary(folder)
+
+    return _libraries[folder]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='Background Library',
+                                     description='Index the background videos and prepare proxies of them')
+    parser.add_argument('-p', '--proxies', action='store_true', required=False,
+                        help='Create pre-cropped 1080x1920 proxies of the videos that don\'t have one.')
+    parser.add_argument('-f', '--force', action='store_true', required=False,
+                        help='Recreate every proxy, even the up to date ones.')
+
+    args = parser.parse_args()
+    library = get_background_library()
+
+    if args.proxies or args.force:
+        library.build_proxies(force=args.force)
+
+    for name, video in sorted(library.refresh().items()):
+        proxy = f", proxy {format_size(video.proxy.size)}" if library.has_proxy(video) else ""
+        print(f"{name}: {video.duration:.1f}s {video.width}x{video.height} {video.fps:.2f}fps {video.codec}, "
+              f"{len(video.keyframes)} keyframes{proxy}")
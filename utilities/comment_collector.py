@@ -1,9 +1,25 @@
+from utilities.post_collector import refresh_scores
+from utilities.scrape_store import get_store
+from utilities.reddit_auth import get_oauth_headers
+from utilities.reddit_client import get_client
+from concurrent.futures import ThreadPoolExecutor
+from utilities.records import Comment
 from dotenv import load_dotenv
-import requests
-import pandas
+import numpy as np
+import heapq
 import os
 
 
+# The furthest the wordcount bounds are widened when no comment fits them
+MAX_BOUND_INCREASE = 200
+
+# The most comment IDs one morechildren request can load
+MORECHILDREN_LIMIT = 100
+
+# How many morechildren chunks are fetched at the same time
+MORECHILDREN_WORKERS = 4
+
+
 def get_top_comments(post_id, subreddit, headers=None):
     '''
     Given a post ID and subreddit, get the top comments from it.
@@ -13,11 +29,11 @@ def get_top_comments(post_id, subreddit, headers=None):
     num_scrape = os.getenv("NUM_SCRAPE")
 
     if headers is not None:
-        r = requests.get(f"https://oauth.reddit.com/r/{subreddit}/comments/{post_id}.json?sort=top&limit={num_scrape}", headers=headers)
+        r = get_client().get(f"https://oauth.reddit.com/r/{subreddit}/comments/{post_id}.json?sort=top&limit={num_scrape}", headers=headers)
     else:
-        r = requests.get(f"https://reddit.com/r/{subreddit}/comments/{post_id}.json?sort=best&limit={num_scrape}")
+        r = get_client().get(f"https://reddit.com/r/{subreddit}/comments/{post_id}.json?sort=best&limit={num_scrape}")
 
-    if(r.status_code == 200):
+    if r is not None and r.status_code == 200:
         return r.json()[1]['data']['children']
     else:
         print(r)
@@ -38,71 +54,110 @@ def get_more_comments(parent_id, next_comments, headers=None):
     }
 
     if headers is not None:
-        r = requests.post("https://oauth.reddit.com/api/morechildren", data=data, headers=headers)
+        r = get_client().post("https://oauth.reddit.com/api/morechildren", data=data, headers=headers)
     else:
-        r = requests.post("https://reddit.com/api/morechildren", data=data)
+        r = get_client().post("https://reddit.com/api/morechildren", data=data)
 
-    if(r.status_code == 200):
+    if r is not None and r.status_code == 200:
         return r.json()['json']['data']['things']
     else:
         print(r)
         return False
 
 
+def append_comments(comments, things, link_id):
+    '''
+    Append the top level comments in a list of things to a list of comment records,
+    and return the IDs of the top level comments that haven't been loaded yet.
+    '''
+    more = []
+    for thing in things:
+        comment = thing['data']
+
+        # Replies are skipped, only comments on the post itself can be used
+        if comment.get('parent_id') != link_id:
+            continue
+
+        if thing['kind'] == 'more':
+            more += comment['children']
+
+        # Check to see if the element is actually a comment
+        elif "total_awards_received" in comment:
+            comments.append(Comment.from_listing(comment))
+
+    return more
+
+
 def accumulate_comments(post_id, subreddit, headers=None, next_comments=None):
     '''
-    Given a post ID and subreddit, return the formatted comments
+    Given a post ID and subreddit, return a list of comment records
     and a list containing the IDs of the next comments to scrape.
+
+    next_comments is a list of up to MORECHILDREN_LIMIT comment IDs to load
+    instead of the first page of comments. If the comments couldn't be fetched,
+    False is returned in place of the list.
     '''
-    df = pandas.DataFrame()
-    new_next_comments = []
+    load_dotenv()
+    num_scrape = os.getenv("NUM_SCRAPE")
+
+    records = []
 
-    # Get comments using the post id and subreddit unless there are no more
     if next_comments == 'end':
-        return df, 'end'
-    elif next_comments is None:
-        comments = get_top_comments(post_id, subreddit, headers=headers)
+        return records, 'end'
+
+    # Serve the comments from the scrape store if they're still fresh,
+    # refreshing the scores of any that have expired
+    store = get_store()
+    listing = f"r/{subreddit}/comments/{post_id}?sort=top&limit={num_scrape}"
+    comments = store.get_page(listing, next_comments)
+    if comments is not None:
+        refresh_scores([comments], headers)
+
+    # Otherwise get comments using the post id and subreddit and save them
     else:
-        comments = get_more_comments("t3_" + post_id, next_comments, headers=headers)
-
-    if comments:
-        # Loop through all supplied comments except the last one,
-        # Which contains the IDs of more comments.
-        for comment in comments:
-            comment = comment['data']
-
-            # Check to see if the element is actually a comment
-            if "total_awards_received" in comment:
-                # Gather award url(s)
-                awards = []
-                if comment['total_awards_received'] != 0:
-                    for award in comment['all_awardings']:
-                        awards.append(award['icon_url'])
-
-                comment_data = pandas.DataFrame([{
-                        'body': comment['body'],
-                        'author': comment['author'],
-                        'upvotes': comment['ups'],
-                        'num_awards': comment['total_awards_received'],
-                        'awards': awards,
-                        'id': comment['name'],
-                        'avatar': '',
-                        'postability': 0
-                    }])
-                df = pandas.concat([df, comment_data], ignore_index=True)
-
-        # Get ids of next comments
-        if 'children' in comments[-1]:
-            new_next_comments = comments[-1]['data']['children']
+        if next_comments is None:
+            comments = get_top_comments(post_id, subreddit, headers=headers)
         else:
-            new_next_comments = 'end'
-            
-    return df, new_next_comments
+            comments = get_more_comments("t3_" + post_id, next_comments, headers=headers)
+
+        if comments is False:
+            return False, next_comments
 
+        store.put_page(listing, next_comments, comments)
 
-def rank_comments(df, bounds, widen_factor=0):
+    # Get the comments along with the ids of the next comments
+    new_next_comments = append_comments(records, comments, "t3_" + post_id)
+    if len(new_next_comments) == 0:
+        new_next_comments = 'end'
+
+    return records, new_next_comments
+
+
+def comment_bounds(bounds, widen_factor=0):
+    '''
+    Given wordcount bounds, return the bounds comments have to fit in.
+    The upper bound is automatically multiplied by 0.5 because you're fetching a comment.
+    '''
+    default_bounds = tuple(map(int, bounds.split(",")))
+
+    return (default_bounds[0], int(0.5 * (default_bounds[1] + widen_factor)))
+
+
+def score_comments(comments):
     '''
-    Given a dataframe of comments, throw away unpostable ones, then calculate most postable one.
+    Given a list of comments, return the wordcount and postability of every comment.
+    '''
+    n = len(comments)
+    wordcount = np.fromiter((comment.body.count(" ") for comment in comments), dtype=np.int64, count=n) + 1
+    upvotes = np.fromiter((comment.upvotes for comment in comments), dtype=float, count=n)
+    num_awards = np.fromiter((comment.num_awards for comment in comments), dtype=float, count=n)
+
+    return wordcount, (upvotes / 10) * wordcount * (20.0 ** num_awards)
+
+
+def rank_comments(comments, bounds, widen_factor=0):
+    '''
+    Given a list of comments, throw away unpostable ones, then calculate most postable one.
 
     widen_factor is used for expanding the upper bound to try to find a post
 
@@ -116,30 +171,57 @@ def rank_comments(df, bounds, widen_factor=0):
         - Postability is calculated by:
             - (upvotes / 10) * word_count * (20**num_awards)
     '''
-    if df.shape[0] == 0:
-        return df
-        
-    load_dotenv()
-    default_bounds = tuple(map(int, bounds.split(",")))
-    # Automatically multiply the upper bound by 0.5 because you're fetching a comment
-    bounds = (default_bounds[0], int(0.5 * (default_bounds[1] + widen_factor)))
-
-    drop_indices = []
-    # Iterate through posts and check all conditions.
-    # Then calculate postability if all conditions met.
-    for index in range(df.shape[0]):
-        wordcount = len(df.iloc[index]['body'].split(" "))
-        if wordcount not in range(*bounds):
-            drop_indices.append(index)
-        else:
-            postability = (df.iloc[index]['upvotes'] / 10) * wordcount * (20**df.iloc[index]['num_awards'])
-            df.at[index, 'postability'] = postability
+    if len(comments) == 0:
+        return []
+
+    bounds = comment_bounds(bounds, widen_factor)
+
+    # Check the bounds and calculate postability for every comment at once
+    wordcount, postability = score_comments(comments)
+    postable = (wordcount >= bounds[0]) & (wordcount < bounds[1])
 
     # Drop unpostables and sort the rest by postability
-    df.drop(drop_indices, inplace=True)
-    df = df.sort_values(by='postability', ascending=False)
+    indices = np.flatnonzero(postable)
+    indices = indices[np.argsort(-postability[indices], kind='stable')]
+    ranked = []
+    for i in indices:
+        comments[i].postability = float(postability[i])
+        ranked.append(comments[i])
+
+    return ranked
+
+
+def rank_widened_comments(comments, bounds, bound_increase, max_increase=MAX_BOUND_INCREASE):
+    '''
+    Given a list of comments, rank them for when none fit the wordcount bounds.
+
+    Each comment gets the smallest multiple of bound_increase (up to max_increase) that
+    the upper bound must be widened by for it to fit, stored in its widen field.
+    Comments are sorted by that and then by postability, so the first comment is the
+    one rank_comments would pick at the smallest widen factor that yields any result.
+    '''
+    if len(comments) == 0 or bound_increase <= 0:
+        return []
+
+    lower, upper = tuple(map(int, bounds.split(",")))
+
+    wordcount, postability = score_comments(comments)
+
+    # The halved upper bound int(0.5 * (upper + widen)) only passes a comment
+    # once upper + widen reaches 2 * (wordcount + 1)
+    distance = np.maximum(2 * (wordcount + 1) - upper, 0)
+    widen = np.maximum(np.ceil(distance / bound_increase), 1) * bound_increase
+    postable = (wordcount >= lower) & (widen <= max_increase)
 
-    return df
+    indices = np.flatnonzero(postable)
+    indices = indices[np.lexsort((-postability[indices], widen[indices]))]
+    ranked = []
+    for i in indices:
+        comments[i].postability = float(postability[i])
+        comments[i].widen = int(widen[i])
+        ranked.append(comments[i])
+
+    return ranked
 
 
 def get_avatar(username, headers=None):
@@ -147,56 +229,126 @@ def get_avatar(username, headers=None):
     Given a Reddit username, get a link to their avatar picture.
     '''
     if headers is not None:
-        r = requests.get(f"https://oauth.reddit.com/user/{username}/about.json", headers=headers)
+        r = get_client().get(f"https://oauth.reddit.com/user/{username}/about.json", headers=headers)
     else:
-        r = requests.get(f"https://reddit.com/user/{username}/about.json")
+        r = get_client().get(f"https://reddit.com/user/{username}/about.json")
 
-    if r.status_code == 200:
+    if r is not None and r.status_code == 200:
         return r.json()['data']['subreddit']['icon_img']
     else:
         print(r)
         return ''
     
 
-def get_top_comment(post, bounds, headers=None):
+def chunk_comments(next_comments):
     '''
-    Given a post, get the top comment from it
+    Split a list of comment IDs into chunks small enough for one morechildren request.
+    '''
+    if next_comments == 'end':
+        return []
+
+    return [next_comments[i:i + MORECHILDREN_LIMIT] for i in range(0, len(next_comments), MORECHILDREN_LIMIT)]
+
+
+def get_top_k_comments(post, bounds, k=1, headers=None):
+    '''
+    Given a post, get its k most postable top level comments, best first.
+
+    The comment tree is walked a few morechildren chunks at a time, fetched concurrently,
+    while a heap keeps the best k comments so far. Comments arrive sorted by score, so
+    the walk stops once a comment with the fewest upvotes seen, at the longest allowed
+    wordcount, couldn't make it into the heap. Like get_top_k_posts, unseen comments
+    are assumed to have no more awards than any comment seen so far.
+    If fewer than k comments fit the bounds, the rest are filled with the best
+    comments at the smallest widening of them.
     '''
     load_dotenv()
     bound_increase = int(os.getenv("BOUND_INCREASE"))
+    workers = int(os.getenv("MORECHILDREN_WORKERS", MORECHILDREN_WORKERS))
+
+    # Use the cached OAuth token if no headers were passed
+    if headers is None:
+        headers = get_oauth_headers()
+
+    longest = comment_bounds(bounds)[1] - 1
+
+    heap = []
+    seen = 0
+    award_cap = 0
+    fewest_upvotes = None
+    total_comments = []
+    pending = [None]
+    while len(pending) != 0:
+        # Stop once no remaining comment could beat the worst kept comment
+        if len(heap) == k and fewest_upvotes is not None:
+            limit = (fewest_upvotes / 10) * longest * (20.0 ** award_cap)
+            if limit <= heap[0][0]:
+                break
+
+        batch, pending = pending[:workers], pending[workers:]
+        concurrent = len(batch) > 1
+        with ThreadPoolExecutor(max_workers=len(batch)) as executor:
+            results = list(executor.map(lambda chunk: accumulate_comments(
+                post['id'], post['subreddit'], headers=headers, next_comments=chunk), batch))
+
+        for chunk, (comments, next_comments) in zip(batch, results):
+            # Retry every chunk that failed alongside others one at a time, as Reddit may
+            # refuse concurrent morechildren calls. A chunk that fails on its own is given up on.
+            if comments is False:
+                if concurrent:
+                    workers = 1
+                    pending.append(chunk)
+                continue
+
+            pending += chunk_comments(next_comments)
+            if len(comments) == 0:
+                continue
+
+            total_comments += comments
+            award_cap = max(award_cap, max(comment.num_awards for comment in comments))
+            least = min(comment.upvotes for comment in comments)
+            fewest_upvotes = least if fewest_upvotes is None else min(fewest_upvotes, least)
+
+            # Keep the best k comments, letting earlier comments win ties like a stable sort
+            for comment in rank_comments(comments, bounds):
+                entry = (comment.postability, -seen, comment)
+                seen += 1
+                if len(heap) < k:
+                    heapq.heappush(heap, entry)
+                elif entry[:2] > heap[0][:2]:
+                    heapq.heapreplace(heap, entry)
+
+    top_comments = [comment for _, _, comment in sorted(heap, key=lambda entry: entry[:2], reverse=True)]
+
+    # If too few comments can be found with the current bounds, 
+    # fill up with the best comments at the smallest widening of them.
+    if len(top_comments) < k and len(total_comments) != 0:
+        kept = {comment.id for comment in top_comments}
+        for comment in rank_widened_comments(total_comments, bounds, bound_increase):
+            if len(top_comments) == k:
+                break
+            if comment.id not in kept:
+                top_comments.append(comment)
+                kept.add(comment.id)
+
+    return top_comments
+
+
+def get_top_comment(post, bounds, headers=None):
+    '''
+    Given a post, get the top comment from it
+    '''
+    # Use the cached OAuth token if no headers were passed
+    if headers is None:
+        headers = get_oauth_headers()
 
-    # Get the first set of comments, and rank them, keeping track of all comments gathered
-    comments, next_comments = accumulate_comments(post['id'], post['subreddit'], headers=headers)
-    total_comments = pandas.DataFrame()
-    total_comments = pandas.concat([total_comments, comments], ignore_index=True)
-    comments = rank_comments(comments, bounds)
-
-    # If no comments meet criteria, paginate through comments until there are no 
-    # more results to get, keeping track of total comments
-    while comments.shape[0] == 0:
-        comments, new_next_comments = accumulate_comments(post['id'], post['subreddit'], 
-                                                        headers=headers, next_comments=next_comments)
-        total_comments = pandas.concat([total_comments, comments], ignore_index=True)
-        if comments.empty:
-            break
-        comments = rank_comments(comments, bounds)
-        next_comments = new_next_comments
-
-    # If no posts can be found with the current bounds, 
-    # gradually widen them until one is.
-    current_bound_increase = bound_increase
-    while comments.shape[0] == 0:
-        running_total = total_comments.copy()
-        comments = rank_comments(total_comments, bounds, widen_factor=current_bound_increase)
-        current_bound_increase = current_bound_increase + bound_increase
-        if current_bound_increase > 200:
-            break
+    comments = get_top_k_comments(post, bounds, k=1, headers=headers)
 
     # If a comment is found, set the top comment to it and fetch the author's avatar
-    if comments.shape[0] != 0:
-        top_comment = comments.iloc[0]
+    if len(comments) != 0:
+        top_comment = comments[0].copy()
         top_comment['avatar'] = get_avatar(top_comment['author'], headers=headers)
     else:
         top_comment = False
 
-    return top_comment
\ No newline at end of file
+    return top_comment
@@ -0,0 +1,102 @@
+from contextlib import contextmanager
+import threading
+import time
+import os
+
+try:
+    import fcntl
+except ImportError:
+    import msvcrt
+
+
+# How often a lock that's held by another process is tried again, in seconds
+POLL_INTERVAL = 0.05
+
+
+def try_lock(fd):
+    '''
+    Try to take an exclusive OS lock on an open file without waiting.
+    Returns True if the lock was taken.
+    '''
+    try:
+        if os.name == "nt":
+            # Windows locks byte ranges, so everyone locks the first byte
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def unlock(fd):
+    '''
+    Release the OS lock taken by try_lock.
+    '''
+    if os.name == "nt":
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class FileLock:
+    '''
+    A lock shared between processes, held as an OS lock on a lock file.
+
+    The operating system releases the lock when its holder exits or crashes, so a
+    lock is never broken while someone still holds it and never left stale. The lock
+    file itself is left in place, as removing it would let two processes lock
+    different files of the same name. With a timeout in seconds, an exception is
+    raised if the lock can't be taken in time, otherwise it waits for as long as it takes.
+    '''
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self.fd = None
+
+    def __enter__(self):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600)
+        while not try_lock(fd):
+            if deadline is not None and time.time() > deadline:
+                os.close(fd)
+                raise Exception(f"Timed out waiting for the lock {self.path}")
+            time.sleep(POLL_INTERVAL)
+
+        self.fd = fd
+        return self
+
+    def __exit__(self, *args):
+        fd, self.fd = self.fd, None
+        try:
+            unlock(fd)
+        finally:
+            os.close(fd)
+
+
+@contextmanager
+def atomic_path(path):
+    '''
+    Give a temporary path to write a file to, then move it over path in one step so
+    other processes never read half of it. If writing fails, the temporary file is removed.
+    '''
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def atomic_write(path, data, mode=0o666):
+    '''
+    Write bytes or a string to a file atomically, see atomic_path.
+    mode sets the permissions of a newly created file.
+    '''
+    with atomic_path(path) as temp_path:
+        fd = os.open(temp_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, mode)
+        with os.fdopen(fd, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
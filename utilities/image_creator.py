@@ -1,12 +1,49 @@
-from html2image import Html2Image
+from utilities.render_pool import get_render_pool
+from utilities.asset_cache import get_asset_cache
+from PIL import Image, ImageDraw, ImageFont
 from dotenv import load_dotenv
-from PIL import Image
 import numpy as np
+import functools
 import random
+import base64
+import html
 import math
+import time
+import io
+import re
 import os
 
 
+# Width of a card, the max-width of the templates' body
+CARD_WIDTH = 750
+# Colors used by the templates
+POST_BACKGROUND = (22, 22, 24)
+CARD_BACKGROUND = (26, 26, 27)
+BORDER_COLOR = (53, 53, 53)
+TEXT_COLOR = (215, 218, 220)
+MUTED_COLOR = (129, 131, 132)
+AVATAR_BACKGROUND = (52, 53, 54)
+DEFAULT_AVATAR = "https://www.redditstatic.com/avatars/avatar_default_02_A5A4A4.png"
+# Fonts tried in order by the pillow backend, Verdana first to match the templates,
+# then the DejaVu Sans copies shipped in utilities/fonts
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+FONTS = ["verdana.ttf", "Verdana.ttf", os.path.join(FONT_DIR, "DejaVuSans.ttf")]
+BOLD_FONTS = ["verdanab.ttf", "Verdana Bold.ttf", os.path.join(FONT_DIR, "DejaVuSans-Bold.ttf")]
+# The embedded icons of the templates, by the id of their <image> element
+ICON_PATTERN = re.compile(r'<image id="(\w+)"[^>]*xlink:href="data:image/png;base64,([^"]+)"')
+UPVOTE_ICON = "image0_1_8"
+COMMENT_ICON = "image0_1_4"
+AWARD_ICON = "image0_1_3"
+SHARE_ICON = "image0_1_7"
+SAVE_ICON = "image0_1_6"
+MORE_ICON = "image0_1_5"
+# How long a url that couldn't be downloaded is skipped before it's tried again, in seconds
+DOWNLOAD_RETRY_SECONDS = 60
+
+_remote_images = {}
+_failed_downloads = {}
+
+
 def format_number(number):
     '''
     Given an int or string that corresponds to a number,
@@ -18,163 +55,403 @@ def format_number(number):
     return str(number)
 
 
-def create_post_image(post, filename):
+@functools.lru_cache(maxsize=None)
+def load_template(path):
     '''
-    Takes in a dataframe of a post and creates an html document of it.
-    Then uses html2image to take a screenshot of it.
+    Read a card template once and split it into its literal text and the names of
+    its _/name/_ placeholders, which alternate starting with text.
     '''
-    load_dotenv()
+    with open(path, "r") as f:
+        document = f.read()
 
-    save_dir = os.getenv('SAVE_PATH')
+    return tuple(re.split(r"_/(\w+)/_", document))
 
-    with open("./utilities/RedditPost.html", "r") as f:
-        document = f.read()
 
-    # Format the body
-    body = post['body']
-    body = body.replace('\n', '<br />')
+def fill_template(template, fields):
+    '''
+    Given a template from load_template and a dictionary of placeholder values,
+    return the finished document.
+    '''
+    return "".join(part if i % 2 == 0 else fields[part] for i, part in enumerate(template))
 
-    # Format the upvotes and comments
-    upvotes = format_number(post['upvotes'])
-    comments = format_number(post['num_comments'])
 
-    # Format the awards (only add up to 8)
-    award_format = "<img style=\"height: 20px; margin-left: 8px;\" src=\"{}\" />"
-    awards = ""
-    for award in post['awards'][0:8]:
-        awards += award_format.format(award)
+def fetch_asset(url):
+    '''
+    Return the contents and content type of an award icon or avatar from the asset cache,
+    or (None, None) if it can't be downloaded. A url that failed is only tried again
+    once DOWNLOAD_RETRY_SECONDS have passed, so a dead link doesn't slow every card down.
+    '''
+    failed = _failed_downloads.get(url)
+    if failed is not None and time.time() - failed < DOWNLOAD_RETRY_SECONDS:
+        return None, None
 
-    # Set the text for all the elements
-    document = document.replace("_/title/_", post['title'])
-    document = document.replace("_/body/_", body)
-    document = document.replace("_/username/_", post['author'])
-    document = document.replace("_/awards/_", awards)
-    document = document.replace("_/upvotes/_", upvotes)
-    document = document.replace("_/num_comments/_", comments)
-    # Make the time a random number between 2 and 23 hours
-    document = document.replace("_/time/_", str(math.ceil(random.random() * 21 + 1)))
+    data, content_type = get_asset_cache().fetch(url)
+    if data is None:
+        _failed_downloads[url] = time.time()
+    else:
+        _failed_downloads.pop(url, None)
 
-    # Take HTML screenshot
-    hti = Html2Image(output_path=save_dir)
-    hti.screenshot(html_str=document, save_as=(filename + ".png"))
+    return data, content_type
 
 
-def create_comment_image(comment, filename):
+def data_uri(url):
     '''
-    Takes in a dataframe of a comment and creates an html document of it.
-    Then uses html2image to take a screenshot of it.
+    Given the url of an award icon or avatar, return it as a data uri from the
+    asset cache so the browser doesn't download it again. Falls back to the url
+    if it can't be downloaded.
     '''
-    load_dotenv()
-
-    save_dir = os.getenv('SAVE_PATH')
+    data, content_type = fetch_asset(url)
+    if data is None:
+        return url
 
-    with open("./utilities/RedditComment.html", "r") as f:
-        document = f.read()
+    return f"data:{content_type or 'image/png'};base64,{base64.b64encode(data).decode()}"
 
-    # Format the body
-    body = comment['body']
-    body = body.replace('\n', '<br />')
 
-    # Format the upvotes
-    upvotes = format_number(comment['upvotes'])
-    
-    # Format the awards (only add up to 8)
+def format_awards(awards):
+    '''
+    Format the awards of a post or comment (only add up to 8).
+    '''
     award_format = "<img style=\"height: 20px; margin-left: 8px;\" src=\"{}\" />"
-    awards = ""
-    for award in comment['awards'][0:8]:
-        awards += award_format.format(award)
 
-    # Format the avatar image
+    return "".join(award_format.format(data_uri(award)) for award in awards[0:8])
+
+
+def format_post_document(post):
+    '''
+    Takes in a post record and creates an html document of it.
+    '''
+    return fill_template(load_template("./utilities/RedditPost.html"), {
+        'title': post['title'],
+        'body': post['body'].replace('\n', '<br />'),
+        'username': post['author'],
+        'awards': format_awards(post['awards']),
+        'upvotes': format_number(post['upvotes']),
+        'num_comments': format_number(post['num_comments']),
+        # Make the time a random number between 2 and 23 hours
+        'time': str(math.ceil(random.random() * 21 + 1)),
+    })
+
+
+def format_comment_document(comment):
+    '''
+    Takes in a comment record and creates an html document of it.
+    '''
     # If the avatar image isn't provided, use the default gray one
-    if comment['avatar'] == "":
-        avatar = "<img style=\"height: 32px; width: 32px;\" src=\"https://www.redditstatic.com/avatars/avatar_default_02_A5A4A4.png\" />"
-    else:
-        avatar = f"<img style=\"height: 32px; width: 32px;\" src=\"{comment['avatar']}\" />"
+    avatar = comment['avatar'] if comment['avatar'] != "" else DEFAULT_AVATAR
 
-    # Set the text for all the elements
-    document = document.replace("_/body/_", body)
-    document = document.replace("_/username/_", comment['author'])
-    document = document.replace("_/awards/_", awards)
-    document = document.replace("_/upvotes/_", upvotes)
-    document = document.replace("_/avatar/_", avatar)
-    # Make the time a random number between 1 and 59 minutes
-    document = document.replace("_/time/_", str(math.ceil(random.random() * 59)))
+    return fill_template(load_template("./utilities/RedditComment.html"), {
+        'body': comment['body'].replace('\n', '<br />'),
+        'username': comment['author'],
+        'awards': format_awards(comment['awards']),
+        'upvotes': format_number(comment['upvotes']),
+        'avatar': f"<img style=\"height: 32px; width: 32px;\" src=\"{data_uri(avatar)}\" />",
+        # Make the time a random number between 1 and 59 minutes
+        'time': str(math.ceil(random.random() * 59)),
+    })
 
-    # Take HTML screenshot
-    hti = Html2Image(output_path=save_dir)
-    hti.screenshot(html_str=document, save_as=(filename + "_comment" + ".png"))
 
-def row_same(row):
+def decode_screenshot(png):
     '''
-    Given a row of an image, return True if all the elements are the same.
+    Decode the PNG bytes of a screenshot into an RGBA array.
     '''
-    for i in range(1, len(row)):
-        if row[0] != row[i] and not row[i]:
-            return False
-        
-    return True
+    with Image.open(io.BytesIO(png)) as image:
+        return np.array(image.convert("RGBA"))
 
 
-def col_same(array, index):
+@functools.lru_cache(maxsize=None)
+def get_font(size, bold=False):
     '''
-    Given an array and a column index, return True if all the elements are the same.
+    Return the first card font that can be loaded at a pixel size.
+    The cards are laid out with FreeType metrics, so there's no bitmap fallback.
     '''
-    for i in range(len(array)):
-        if array[i][0] != array[i][index]:
-            return False
-        
-    return True
+    names = BOLD_FONTS if bold else FONTS
+    for name in names:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            pass
+
+    raise Exception(f"None of the card fonts {names} could be loaded")
 
 
-def clean_image(filename):
+@functools.lru_cache(maxsize=None)
+def get_icons(template):
     '''
-    Given a filename, remove the black background and unnecessary pixels from the image.
+    Given the path of a card template, return its embedded icons by id.
     '''
-    load_dotenv()
+    document = "".join(load_template(template))
 
-    save_dir = os.getenv('SAVE_PATH')
-    image = Image.open(os.path.join(save_dir, filename + ".png"))
+    return {icon_id: Image.open(io.BytesIO(base64.b64decode(data))).convert("RGBA")
+            for icon_id, data in ICON_PATTERN.findall(document)}
 
-    image = np.array(image.convert("RGBA"))
 
-    # Get ids of black pixels and set to transparent
-    idx = (image[...,:3] == np.array((0,0,0))).all(axis=-1)
-    image[idx,3] = 0
+def fetch_image(url):
+    '''
+    Load an award icon or avatar from the asset cache, returning None if it can't be loaded.
+    Decoded images are also kept in memory for the rest of the run, failures aren't.
+    '''
+    if url not in _remote_images:
+        data = fetch_asset(url)[0]
+        if data is None:
+            return None
+        try:
+            _remote_images[url] = Image.open(io.BytesIO(data)).convert("RGBA")
+        except OSError as e:
+            print(e)
+            return None
 
-    # Delete all fully-transparent rows
-    transparent_rows = []
-    idx = np.array(idx)
-    for i, row in enumerate(idx):
-        if row_same(row):
-            transparent_rows.append(i)
+    return _remote_images[url]
 
-    idx = np.delete(idx, transparent_rows, 0)
-    image = np.delete(image, transparent_rows, 0)
 
-    # # Do the same for columns
-    transparent_rows.clear()
-    for i in range(len(idx[0])):
-        if col_same(idx, i):
-            transparent_rows.append(i)
+def fit_image(image, width, height):
+    '''
+    Scale an image to fit a box without stretching it and center it there,
+    like an <svg> viewBox does.
+    '''
+    scale = min(width / image.width, height / image.height)
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    box = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    box.paste(image.resize(size, Image.LANCZOS), ((width - size[0]) // 2, (height - size[1]) // 2))
 
-    image = np.delete(image, transparent_rows, 1)
+    return box
 
-    # Save image
-    image = Image.fromarray(image)
 
-    image = image.save(os.path.join(save_dir, filename + ".png"))
+def wrap_text(text, font, width):
+    '''
+    Break text into lines that fit in a width, keeping its line breaks.
+    '''
+    # Each word is measured once and lines are measured as the sum of their words
+    space = font.getlength(" ")
+    widths = {}
+
+    lines = []
+    for paragraph in html.unescape(text).split("\n"):
+        line = []
+        line_width = 0
+        for word in paragraph.split():
+            if word not in widths:
+                widths[word] = font.getlength(word)
+            if line and line_width + space + widths[word] > width:
+                lines.append(" ".join(line))
+                line = []
+            line_width = widths[word] if not line else line_width + space + widths[word]
+            line.append(word)
+        lines.append(" ".join(line))
+
+    return lines
+
+
+def draw_line(draw, x, y, text, font, fill, line_height):
+    '''
+    Draw a line of text vertically centered in a line box whose top is at y.
+    Returns the x coordinate just after the text.
+    '''
+    ascent, descent = font.getmetrics()
+    draw.text((x, y + (line_height - ascent - descent) / 2 + ascent), text, font=font, fill=fill, anchor="ls")
+
+    return x + font.getlength(text)
+
+
+def draw_awards(card, x, y, awards):
+    '''
+    Draw up to 8 award icons 20px tall after the header of a card.
+    '''
+    for url in awards[0:8]:
+        icon = fetch_image(url)
+        if icon is None:
+            continue
+        width = max(1, round(icon.width * 20 / icon.height))
+        icon = icon.resize((width, 20), Image.LANCZOS)
+        x += 8
+        card.alpha_composite(icon, (round(x), y))
+        x += width
+
+
+def finish_card(card):
+    '''
+    Give a card its rounded corners and border.
+    '''
+    mask = Image.new("L", card.size, 0)
+    ImageDraw.Draw(mask).rounded_rectangle((0, 0, card.width - 1, card.height - 1), radius=12, fill=255)
+    card.putalpha(mask)
+    ImageDraw.Draw(card).rounded_rectangle((0, 0, card.width - 1, card.height - 1), radius=12,
+                                           outline=BORDER_COLOR, width=1)
+
+    return card
+
+
+def draw_post_card(post):
+    '''
+    Takes in a post record and draws it with Pillow using the layout of RedditPost.html.
+    Returns a tightly cropped RGBA image, so it doesn't need cleaning.
+    '''
+    icons = get_icons("./utilities/RedditPost.html")
+    upvote = fit_image(icons[UPVOTE_ICON], 24, 24)
+
+    # The vote column is 48px wide and the content is padded by 14px. Text wraps
+    # inside the template's 1.5px borders, so the lines are a pixel narrower than the card
+    left = 1 + 48
+    x = left + 14
+    text_width = CARD_WIDTH - 3 - 48 - 28
+
+    header_height = 20 if len(post['awards']) > 0 else 16
+    title_lines = wrap_text(post['title'], get_font(22, bold=True), text_width)
+    body_lines = wrap_text(post['body'], get_font(20), text_width) if post['body'] != "" else []
+
+    title_y = 1 + 14 + header_height + 12
+    body_y = title_y + 22 * len(title_lines) + 14
+    actions_y = body_y + 24 * len(body_lines) + 20
+    height = max(actions_y + 24 + 14, 88) + 1
+
+    card = Image.new("RGBA", (CARD_WIDTH, height), POST_BACKGROUND + (255,))
+    draw = ImageDraw.Draw(card)
+    draw.rectangle((left, 0, CARD_WIDTH - 1, height - 1), fill=CARD_BACKGROUND)
+
+    # Vote column
+    card.alpha_composite(upvote, (1 + 4 + 10, 1 + 12))
+    upvotes = format_number(post['upvotes'])
+    font = get_font(14, bold=True)
+    draw_line(draw, 1 + 4 + 22 - font.getlength(upvotes) / 2, 1 + 42, upvotes, font, TEXT_COLOR, 16)
+    card.alpha_composite(upvote.rotate(180), (1 + 4 + 10, 1 + 64))
+
+    # Header, title and body
+    header = f"Posted by u/{post['author']} {math.ceil(random.random() * 21 + 1)} hours ago"
+    end = draw_line(draw, x, 1 + 14 + (header_height - 16) // 2, header, get_font(16), MUTED_COLOR, 16)
+    draw_awards(card, end, 1 + 14, post['awards'])
+
+    for i, line in enumerate(title_lines):
+        draw_line(draw, x, title_y + 22 * i, line, get_font(22, bold=True), TEXT_COLOR, 22)
+    for i, line in enumerate(body_lines):
+        draw_line(draw, x, body_y + 24 * i, line, get_font(20), TEXT_COLOR, 24)
+
+    # Comment, award, share, save and more buttons
+    actions = [(COMMENT_ICON, f"{format_number(post['num_comments'])} Comments"),
+               (AWARD_ICON, "Award"), (SHARE_ICON, "Share"), (SAVE_ICON, "Save"), (MORE_ICON, None)]
+    for i, (icon, label) in enumerate(actions):
+        x += 24 if i > 0 else 0
+        card.alpha_composite(fit_image(icons[icon], 24, 24), (round(x), actions_y))
+        x += 24
+        if label is not None:
+            x = draw_line(draw, x + 4, actions_y + 3, label, font, MUTED_COLOR, 17)
+
+    return finish_card(card)
+
+
+def draw_comment_card(comment):
+    '''
+    Takes in a comment record and draws it with Pillow using the layout of RedditComment.html.
+    Returns a tightly cropped RGBA image, so it doesn't need cleaning.
+    '''
+    icons = get_icons("./utilities/RedditComment.html")
+    upvote = fit_image(icons[UPVOTE_ICON], 24, 24)
+
+    # The avatar column is 44px wide and the content is padded by 14px
+    x = 1 + 44 + 14
+    text_width = CARD_WIDTH - 3 - 44 - 28
+
+    header_height = 20 if len(comment['awards']) > 0 else 16
+    body_lines = wrap_text(comment['body'], get_font(20), text_width)
+
+    body_y = 1 + 14 + header_height + 14
+    actions_y = body_y + 24 * len(body_lines) + 14
+    height = actions_y + 24 + 14 + 1
+
+    card = Image.new("RGBA", (CARD_WIDTH, height), CARD_BACKGROUND + (255,))
+    draw = ImageDraw.Draw(card)
+
+    # Avatar and thread line
+    avatar_url = comment['avatar'] if comment['avatar'] != "" else DEFAULT_AVATAR
+    avatar = Image.new("RGBA", (32, 32), AVATAR_BACKGROUND + (255,))
+    image = fetch_image(avatar_url)
+    if image is not None:
+        avatar.alpha_composite(image.resize((32, 32), Image.LANCZOS))
+    mask = Image.new("L", (32, 32), 0)
+    ImageDraw.Draw(mask).ellipse((0, 0, 31, 31), fill=255)
+    card.paste(avatar, (1 + 10, 1 + 7), mask)
+    draw.rectangle((1 + 26, 1 + 46, 1 + 27, height - 1), fill=AVATAR_BACKGROUND)
+
+    # Header and body
+    end = draw_line(draw, x, 1 + 14 + (header_height - 16) // 2, comment['author'],
+                    get_font(14, bold=True), "white", 16)
+    end = draw_line(draw, end, 1 + 14 + (header_height - 16) // 2,
+                    f" - {math.ceil(random.random() * 59)} min. ago", get_font(14), MUTED_COLOR, 16)
+    draw_awards(card, end, 1 + 14, comment['awards'])
+
+    for i, line in enumerate(body_lines):
+        draw_line(draw, x, body_y + 24 * i, line, get_font(20), TEXT_COLOR, 24)
+
+    # Vote, reply, share and more buttons
+    font = get_font(14, bold=True)
+    card.alpha_composite(upvote, (x, actions_y))
+    x = draw_line(draw, x + 24 + 4 + 4, actions_y + 3, format_number(comment['upvotes']), font, "white", 17)
+    card.alpha_composite(upvote.rotate(180), (round(x + 4), actions_y))
+    x += 4 + 24 + 4 + 12 + 6
+    card.alpha_composite(fit_image(icons[COMMENT_ICON], 24, 24), (round(x), actions_y))
+    x = draw_line(draw, x + 24 + 4, actions_y + 3, "Reply", font, MUTED_COLOR, 17)
+    x = draw_line(draw, x + 24, actions_y + 3, "Share", font, MUTED_COLOR, 17)
+    card.alpha_composite(fit_image(icons[MORE_ICON], 24, 24), (round(x + 24), actions_y))
+
+    return finish_card(card)
+
+
+def trim_image(image):
+    '''
+    Given an RGBA image array, make the black background transparent and crop
+    the image to the bounding box of its remaining pixels.
+    '''
+    # View each pixel as one little-endian 32 bit int so it's checked in a single comparison
+    pixels = np.ascontiguousarray(image).view('<u4')[..., 0]
+    black = (pixels & 0x00FFFFFF) == 0
+    opaque = ~black & (pixels > 0x00FFFFFF)
+
+    # Crop away the fully-transparent rows and columns around the card
+    rows = np.flatnonzero(opaque.any(axis=1))
+    cols = np.flatnonzero(opaque.any(axis=0))
+    if len(rows) == 0:
+        return image[:0, :0].copy()
+
+    crop = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+    image = image[crop].copy()
 
+    # Set the black pixels left inside the card to transparent
+    image[black[crop], 3] = 0
 
-def create_image(post, filename, comment=None):
+    return image
+
+
+def create_image(post, filename, comment=None, backend=None):
     '''
-    Helper function to create and clean a post image.
+    Helper function to create and clean the post image, and the comment image if a
+    comment is given. Returns them as RGBA arrays, with None for a missing comment.
+
+    backend is either "html", which renders the templates on the browser render pool
+    (the post and comment at the same time), or "pillow", which draws the cards
+    without a browser. It defaults to RENDER_BACKEND in .env, or "html" if that isn't set.
+
+    The images are only written to SAVE_PATH (as filename.png and filename_comment.png)
+    if SAVE_CARDS in .env is set to true, which is useful for debugging.
     '''
-    create_post_image(post, filename)
-    clean_image(filename)
+    load_dotenv()
+    backend = backend or os.getenv('RENDER_BACKEND', 'html')
+
+    if backend == 'pillow':
+        images = [np.array(draw_post_card(post))]
+        if comment is not None:
+            images.append(np.array(draw_comment_card(comment)))
+    elif backend == 'html':
+        documents = [format_post_document(post)]
+        if comment is not None:
+            documents.append(format_comment_document(comment))
+        images = [trim_image(decode_screenshot(png)) for png in get_render_pool().render_many(documents)]
+    else:
+        raise Exception(f"Unknown render backend {backend}")
+
+    if os.getenv('SAVE_CARDS', 'false').lower() == 'true':
+        save_dir = os.getenv('SAVE_PATH')
+        for image, name in zip(images, [filename, filename + "_comment"]):
+            Image.fromarray(image).save(os.path.join(save_dir, name + ".png"))
 
-    if comment is not None:
-        create_comment_image(comment, filename)
-        clean_image(filename + "_comment")
+    return images[0], images[1] if comment is not None else None
 
 
 if __name__ == "__main__":
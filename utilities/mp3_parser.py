@@ -0,0 +1,93 @@
+# Bitrates in kbps by (MPEG-1, layer) and (MPEG-2 or 2.5, layer), indexed by the header's bitrate bits
+BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# Sample rates by the header's version bits (0 is MPEG-2.5, 2 is MPEG-2 and 3 is MPEG-1)
+SAMPLE_RATES = {0: [11025, 12000, 8000], 2: [22050, 24000, 16000], 3: [44100, 48000, 32000]}
+
+
+def skip_id3(data):
+    '''
+    Return the offset of the first byte after an ID3v2 tag, or 0 if there isn't one.
+    '''
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+
+    # The tag size is stored as four 7 bit bytes
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+
+    return 10 + size + footer
+
+
+def parse_header(data, offset):
+    '''
+    Parse the MPEG audio frame header at an offset.
+    Returns (frame length, samples, sample rate), or None if there isn't a valid header there.
+    '''
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+
+    version = (data[offset + 1] >> 3) & 3
+    layer = 4 - ((data[offset + 1] >> 1) & 3)
+    bitrate_index = data[offset + 2] >> 4
+    rate_index = (data[offset + 2] >> 2) & 3
+    padding = (data[offset + 2] >> 1) & 1
+
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    bitrate = BITRATES[(version == 3, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][rate_index]
+
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+
+    samples = 1152 if layer == 2 or version == 3 else 576
+
+    return samples // 8 * bitrate // sample_rate + padding, samples, sample_rate
+
+
+def is_info_frame(data, offset, length):
+    '''
+    Return True if a frame is a Xing / Info / VBRI header frame, which holds no audio.
+    '''
+    frame = data[offset:offset + length]
+
+    return b"Xing" in frame[:64] or b"Info" in frame[:64] or b"VBRI" in frame[:64]
+
+
+def iter_frames(data):
+    '''
+    Given the bytes of an MP3 file, yield (offset, length, samples, sample rate) for each
+    of its audio frames. Tags, header frames and junk between frames are skipped.
+    '''
+    offset = skip_id3(data)
+    first = True
+
+    while offset + 4 <= len(data):
+        header = parse_header(data, offset)
+        # Resync on the next byte if this isn't a frame, or the frame runs past the end
+        if header is None or offset + header[0] > len(data):
+            offset += 1
+            continue
+
+        length, samples, sample_rate = header
+        if not (first and is_info_frame(data, offset, length)):
+            yield offset, length, samples, sample_rate
+
+        first = False
+        offset += length
+
+
+def mp3_duration(data):
+    '''
+    Given the bytes of an MP3 file, return its duration in seconds without decoding it.
+    '''
+    return sum(samples / sample_rate for _, _, samples, sample_rate in iter_frames(data))
+
@@ -1,126 +1,287 @@
+from concurrent.futures import ThreadPoolExecutor
+from utilities.scrape_store import get_store, refresh_children
+from utilities.reddit_auth import get_oauth_headers
+from utilities.reddit_client import get_client
+from utilities.records import Post
 from dotenv import load_dotenv
-import requests
-import pandas
+import numpy as np
+import heapq
+import re
 import os
 
 
-def get_oauth_headers():
-    '''
-    Using the environment variables saved in .env, get an OAuth token and return a header
-    '''
-    load_dotenv()
-    client_id = os.getenv("CLIENT_ID")
-    secret_token = os.getenv("SECRET_TOKEN")
-    username = os.getenv("REDDIT_USERNAME")
-    password = os.getenv("REDDIT_PASSWORD")
-
-    auth = requests.auth.HTTPBasicAuth(client_id, secret_token)
+# Upper bound on the number of subreddits fetched at the same time
+MAX_FETCH_WORKERS = 16
 
-    data = {'grant_type': 'password',
-        'username': username,
-        'password': password}
-    
-    headers = {'User-Agent': 'Content_Scraper/0.1'}
+# Substrings of a post's url that mean it links to an image
+IMAGE_PATTERN = "jpg|jpeg|png|gif"
 
-    r = requests.post('https://www.reddit.com/api/v1/access_token',
-                    auth=auth, data=data, headers=headers)
-    
-    if r.status_code != 200:
-        print(r)
-    
-    TOKEN = r.json()['access_token']
+# The furthest the wordcount bounds are widened when no post fits them
+MAX_BOUND_INCREASE = 300
 
-    headers = {**headers, **{'Authorization': f"bearer {TOKEN}"}}
+# In coalesced mode, subreddits with fewer posts than this in their group's
+# first page get a request of their own
+MIN_PER_SUBREDDIT = 10
 
-    return headers
+IMAGE_REGEX = re.compile(IMAGE_PATTERN)
 
 
-def get_top_posts(subreddit, headers=None, final_id=None):
+def get_top_posts(subreddit, headers=None, final_id=None, limit=None):
     '''
     Given a subreddit, fetch the top posts in the past 23 hours.
     If OAuth headers are passed, they will be used in the get request.
+
+    subreddit can also be a combined listing like "a+b+c", and limit
+    overrides the NUM_SCRAPE posts fetched per request.
     '''
     load_dotenv()
-    num_scrape = os.getenv("NUM_SCRAPE")
+    num_scrape = limit if limit is not None else os.getenv("NUM_SCRAPE")
+    client = get_client()
 
     # Based on whether a header and final ID is passed, call the proper endpoint
     if headers is not None:
-        if final_id is not None:
-            r = requests.get(f"https://oauth.reddit.com/r/{subreddit}/top.json?sort=top&t=23h&limit={num_scrape}&after={final_id}", headers=headers)
-        else:
-            r = requests.get(f"https://oauth.reddit.com/r/{subreddit}/top.json?sort=top&t=23h&limit={num_scrape}", headers=headers)
+        url = f"https://oauth.reddit.com/r/{subreddit}/top.json?sort=top&t=23h&limit={num_scrape}"
     else:
-        if final_id is not None:
-            r = requests.get(f"https://www.reddit.com/r/{subreddit}/top.json?sort=top&t=23h&limit={num_scrape}&after={final_id}")
-        else:
-            r = requests.get(f"https://www.reddit.com/r/{subreddit}/top.json?sort=top&t=23h&limit={num_scrape}")
+        url = f"https://www.reddit.com/r/{subreddit}/top.json?sort=top&t=23h&limit={num_scrape}"
+    if final_id is not None:
+        url += f"&after={final_id}"
 
-    if(r.status_code == 200):
+    r = client.get(url, headers=headers)
+
+    if r is not None and r.status_code == 200:
         return r.json()['data']['children']
     else:
         print(r)
         return False
     
 
-def accumulate_posts(subreddits, headers=None, final_ids=None):
+def get_info(fullnames, headers=None):
+    '''
+    Given up to 100 post or comment fullnames, get their current data in one request.
+    This is how scores of stored posts and comments are refreshed without walking
+    their listings again.
+    '''
+    client = get_client()
+    ids = ",".join(fullnames)
+
+    if headers is not None:
+        r = client.get(f"https://oauth.reddit.com/api/info.json?id={ids}", headers=headers)
+    else:
+        r = client.get(f"https://www.reddit.com/api/info.json?id={ids}")
+
+    if r is not None and r.status_code == 200:
+        return r.json()['data']['children']
+    else:
+        print(r)
+        return False
+
+
+def refresh_scores(pages, headers=None, skip=None):
+    '''
+    Given listing pages served from the scrape store, refresh the posts or comments
+    whose scores have expired, 100 per request. Anything skip returns True for
+    (e.g. posts that can never be ranked) is left as it is.
+    '''
+    store = get_store()
+
+    fullnames = [child['data']['name'] for page in pages for child in page
+                 if child['kind'] != 'more' and (skip is None or not skip(child['data']))]
+    stale = store.stale_fullnames(fullnames)
+    if len(stale) == 0:
+        return
+
+    batches = [stale[i:i + 100] for i in range(0, len(stale), 100)]
+    workers = min(MAX_FETCH_WORKERS, len(batches))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda batch: get_info(batch, headers), batches))
+
+    refreshed = [child for result in results if result for child in result]
+    store.update_things(refreshed)
+    refresh_children(pages, refreshed)
+
+
+def can_rank(post):
+    '''
+    Given the data of a post, return False if no bounds could ever make it postable.
+    '''
+    return not post['over_18'] and IMAGE_REGEX.search(post['url']) is None
+
+
+def fetch_subreddits(subreddits, headers=None, final_ids=None, limit=None):
+    '''
+    Fetch the next page of top posts for every subreddit at the same time over the
+    shared Reddit client. Results are returned in the same order as the subreddits, with an
+    empty list for subreddits whose final ID is 'end'.
+    '''
+    if final_ids is None:
+        final_ids = [None] * len(subreddits)
+
+    def fetch(i):
+        if final_ids[i] == 'end':
+            return []
+        return get_top_posts(subreddits[i], headers, final_ids[i], limit)
+
+    if len(subreddits) == 0:
+        return []
+
+    workers = min(MAX_FETCH_WORKERS, len(subreddits))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fetch, range(len(subreddits))))
+
+
+def load_pages(subreddits, headers=None, final_ids=None, limit=None):
+    '''
+    Get the next page of top posts for every subreddit, serving pages from the
+    scrape store when they're still fresh and fetching the rest concurrently.
+    Pages that couldn't be fetched are False.
+    '''
+    load_dotenv()
+    num_scrape = limit if limit is not None else os.getenv("NUM_SCRAPE")
+
+    if final_ids is None:
+        final_ids = [None] * len(subreddits)
+
+    # Serve pages from the scrape store when they're still fresh
+    store = get_store()
+    listings = [f"r/{subreddit}/top?t=23h&limit={num_scrape}" for subreddit in subreddits]
+    pages = [None] * len(subreddits)
+    for i in range(len(subreddits)):
+        if final_ids[i] != 'end':
+            pages[i] = store.get_page(listings[i], final_ids[i])
+    stored_pages = [page for page in pages if page is not None]
+    missing = [i for i in range(len(subreddits)) if pages[i] is None]
+
+    # Scrape every other subreddit concurrently and save the pages
+    fetched = fetch_subreddits([subreddits[i] for i in missing], headers,
+                               [final_ids[i] for i in missing], limit)
+    for i, page in zip(missing, fetched):
+        pages[i] = page
+        if page is not False and final_ids[i] != 'end':
+            store.put_page(listings[i], final_ids[i], page)
+
+    # Refresh the scores of stored posts that could still be ranked
+    refresh_scores(stored_pages, headers, skip=lambda post: not can_rank(post))
+
+    return pages
+
+
+def group_subreddits(subreddits, group_size):
+    '''
+    Split subreddits into combined listings like "a+b+c" of up to group_size subreddits.
+    '''
+    return ["+".join(subreddits[i:i + group_size]) for i in range(0, len(subreddits), group_size)]
+
+
+def demultiplex(page, subreddits):
+    '''
+    Given a page of a combined listing and the subreddits in it, split it into
+    a list of posts for each subreddit, keeping the listing order within each one.
+    '''
+    index = {subreddit.lower(): i for i, subreddit in enumerate(subreddits)}
+    split = [[] for _ in subreddits]
+    for post in page:
+        i = index.get(post['data']['subreddit'].lower())
+        if i is not None:
+            split[i].append(post)
+
+    return split
+
+
+def append_posts(posts, listing):
+    '''
+    Append the posts of a listing to a list of post records.
+    '''
+    for post in listing:
+        posts.append(Post.from_listing(post['data']))
+
+
+def accumulate_posts(subreddits, headers=None, final_ids=None, group_size=1, min_per_subreddit=MIN_PER_SUBREDDIT):
     '''
     Iterate through subreddits provided and get the specific number of posts to be
-    saved to a pandas dataframe
+    saved to a list of post records
+
+    If group_size is more than one, the subreddits are fetched group_size at a time
+    through combined listings (/r/a+b+c/top) and final_ids holds one ID per group.
+    On the first page, subreddits with fewer than min_per_subreddit posts in their
+    group's listing are topped up with a request of their own, so busy subreddits
+    can't crowd out quiet ones.
     '''
     load_dotenv()
     num_scrape = os.getenv("NUM_SCRAPE")
 
-    df = pandas.DataFrame()
-    
+    posts = []
+
+    units = group_subreddits(subreddits, group_size) if group_size > 1 else subreddits
+
     if final_ids is None:
-        final_ids = [None] * len(subreddits)
+        final_ids = [None] * len(units)
 
-    new_final_ids = [None] * len(subreddits)
+    new_final_ids = [None] * len(units)
+
+    pages = load_pages(units, headers, final_ids)
+
+    # Split combined listings back into posts per subreddit
+    unit_posts = []
+    for i, unit_page in enumerate(pages):
+        # A failed request counts as reaching the end of the subreddit
+        if not unit_page:
+            unit_page = []
 
-    for i, subreddit in enumerate(subreddits):
-        # Scrape more posts until the end is reached
-        if final_ids[i] != 'end':
-            subreddit_posts = get_top_posts(subreddit, headers, final_ids[i])
-        else:
-            subreddit_posts = []
-        
         # Only append a final ID if it's possible to get more posts
-        if len(subreddit_posts) == int(num_scrape):
-            new_final_ids[i] = subreddit_posts[-1]['data']['name']
+        if len(unit_page) == int(num_scrape):
+            new_final_ids[i] = unit_page[-1]['data']['name']
         else:
             new_final_ids[i] = 'end'
 
-        if subreddit_posts:
-            for post in subreddit_posts:
-                post = post['data']
-                # Gather award url(s)
-                awards = []
-                if post['total_awards_received'] != 0:
-                    for award in post['all_awardings']:
-                        awards.append(award['icon_url'])
-
-                post_data = pandas.DataFrame([{
-                    'title': post['title'],
-                    'body': post['selftext'],
-                    'author': post['author'],
-                    'id': post['id'],
-                    'upvotes': post['ups'],
-                    'num_awards': post['total_awards_received'],
-                    'num_comments': post['num_comments'],
-                    'url': post['url'],
-                    'awards': awards,
-                    'nsfw': post['over_18'],
-                    'subreddit': post['subreddit'],
-                    'postability': 0
-                }])
-                df = pandas.concat([df, post_data], ignore_index=True)
-
-    return df, new_final_ids
-
-
-def rank_posts(df, bounds, widen_factor=0, ub_multiplier=1):
-    '''
-    Given a dataframe of posts, throw away unpostable ones, then calculate most postable one.
+        if group_size > 1:
+            unit_posts.append(demultiplex(unit_page, units[i].split("+")))
+        else:
+            unit_posts.append([unit_page])
+
+    # Top up subreddits that got too few posts from their group's first page
+    if group_size > 1 and min_per_subreddit > 0:
+        starved = [(i, j, member) for i, unit in enumerate(units) if final_ids[i] is None
+                   for j, member in enumerate(unit.split("+")) if len(unit_posts[i][j]) < min_per_subreddit]
+        top_ups = load_pages([member for _, _, member in starved], headers, limit=min_per_subreddit)
+        for (i, j, _), top_up in zip(starved, top_ups):
+            seen = {post['data']['name'] for post in unit_posts[i][j]}
+            unit_posts[i][j] += [post for post in (top_up or []) if post['data']['name'] not in seen]
+
+    # Process the posts in subreddit order
+    for split in unit_posts:
+        for subreddit_posts in split:
+            append_posts(posts, subreddit_posts)
+
+    return posts, new_final_ids
+
+
+def count_words(texts):
+    '''
+    Given a list of strings, return an array of the number of words in each one.
+    Words are separated by single spaces, the same as str.split(" ").
+    '''
+    return np.fromiter((text.count(" ") for text in texts), dtype=np.int64, count=len(texts)) + 1
+
+
+def score_posts(posts):
+    '''
+    Given a list of posts, return the wordcount of every post, whether it is
+    free of NSFW content and images, and its postability.
+    '''
+    n = len(posts)
+    wordcount = count_words([post.body for post in posts]) + count_words([post.title for post in posts])
+    clean = np.fromiter((not post.nsfw and IMAGE_REGEX.search(post.url) is None for post in posts),
+                        dtype=bool, count=n)
+    upvotes = np.fromiter((post.upvotes for post in posts), dtype=float, count=n)
+    num_awards = np.fromiter((post.num_awards for post in posts), dtype=float, count=n)
+    postability = (upvotes / 10) * wordcount * (20.0 ** num_awards)
+
+    return wordcount, clean, postability
+
+
+def rank_posts(posts, bounds, widen_factor=0, ub_multiplier=1):
+    '''
+    Given a list of posts, throw away unpostable ones, then calculate most postable one.
 
     widen_factor is used for expanding the upper bound to try to find a post
     ub_multiplier is used when trying to scrape a comment as well, shrinking the upper bound
@@ -137,80 +298,160 @@ def rank_posts(df, bounds, widen_factor=0, ub_multiplier=1):
         - Postability is calculated by:
             - (upvotes / 10) * word_count * (20**num_awards)
     '''
-    if df.shape[0] == 0:
-        return df
-    
-    load_dotenv()
+    if len(posts) == 0:
+        return []
+
     default_bounds = tuple(map(int, bounds.split(",")))
     bounds = (max(0, default_bounds[0] - widen_factor), (default_bounds[1] + widen_factor))
     if ub_multiplier != 1:
-        bounds[1] = int(ub_multiplier * bounds[1])
-
-    drop_indices = []
-    # Iterate through posts and check all conditions.
-    # Then calculate postability if all conditions met.
-    for index in range(df.shape[0]):
-        wordcount = len(df.iloc[index]['body'].split(" ")) + len(df.iloc[index]['title'].split(" "))
-
-        # Check if the post contains an image
-        contains_image = False
-        if "jpg" in df.iloc[index]['url'] or "jpeg" in df.iloc[index]['url'] or \
-        "png" in df.iloc[index]['url'] or "gif" in df.iloc[index]['url']:
-            contains_image = True
-
-        if wordcount not in range(*bounds) or df.iloc[index]['nsfw'] or contains_image:
-            drop_indices.append(index)
-        else:
-            postability = (df.iloc[index]['upvotes'] / 10) * wordcount * (20**df.iloc[index]['num_awards'])
-            df.at[index, 'postability'] = postability
+        bounds = (bounds[0], int(ub_multiplier * bounds[1]))
 
-    # Drop unpostables and sort the rest by postability
-    df.drop(drop_indices, inplace=True)
-    df = df.sort_values(by='postability', ascending=False)
+    # Check all conditions for every post at once
+    wordcount, clean, postability = score_posts(posts)
+    postable = (wordcount >= bounds[0]) & (wordcount < bounds[1]) & clean
 
-    return df
+    # Keep the posts that meet all conditions and sort them by postability
+    indices = np.flatnonzero(postable)
+    indices = indices[np.argsort(-postability[indices], kind='stable')]
+    ranked = []
+    for i in indices:
+        posts[i].postability = float(postability[i])
+        ranked.append(posts[i])
 
+    return ranked
 
-def get_top_post(subreddits, bounds):
+
+def rank_widened_posts(posts, bounds, bound_increase, max_increase=MAX_BOUND_INCREASE):
     '''
-    Get the most postable reddit post (and comment if applicable) from the subreddit(s) given
+    Given a list of posts, rank them for when none fit the wordcount bounds.
+
+    Each post gets the smallest multiple of bound_increase (up to max_increase) that
+    the bounds must be widened by for it to fit, stored in its widen field.
+    Posts are sorted by that and then by postability, so the first post is the
+    one rank_posts would pick at the smallest widen factor that yields any result.
+    '''
+    if len(posts) == 0 or bound_increase <= 0:
+        return []
+
+    lower, upper = tuple(map(int, bounds.split(",")))
+
+    wordcount, clean, postability = score_posts(posts)
+
+    # How many words each post falls outside of [lower, upper)
+    distance = np.maximum(np.maximum(lower - wordcount, wordcount - upper + 1), 0)
+    widen = np.maximum(np.ceil(distance / bound_increase), 1) * bound_increase
+    postable = clean & (widen <= max_increase)
+
+    indices = np.flatnonzero(postable)
+    indices = indices[np.lexsort((-postability[indices], widen[indices]))]
+    ranked = []
+    for i in indices:
+        posts[i].postability = float(postability[i])
+        posts[i].widen = int(widen[i])
+        ranked.append(posts[i])
+
+    return ranked
+
+
+def unseen_bound(posts, final_ids, bounds, award_cap):
+    '''
+    Given the latest page of posts and the IDs pagination will continue from,
+    return an upper bound on the postability of any post not seen yet in each listing.
+
+    top listings are sorted by score, so no unseen post has more upvotes than the
+    last post of the page, and none can be longer than the upper wordcount bound.
+    Awards can't be bounded from the listing, so unseen posts are assumed to have
+    at most award_cap awards. Listings that have ended get a bound of -1.
+    '''
+    upper = int(bounds.split(",")[1])
+    upvotes = {"t3_" + post.id: post.upvotes for post in posts}
+
+    limits = []
+    for final_id in final_ids:
+        if final_id == 'end' or final_id not in upvotes:
+            limits.append(-1)
+        else:
+            limits.append((upvotes[final_id] / 10) * (upper - 1) * (20.0 ** award_cap))
+
+    return limits
+
+
+def get_top_k_posts(subreddits, bounds, k=1, group_size=1):
+    '''
+    Get the k most postable reddit posts from the subreddit(s) given, best first.
+
+    Pages are streamed into a heap of the best k posts so far, and each listing stops
+    paginating as soon as the bound from unseen_bound shows none of its unseen posts
+    could make it into the heap. If fewer than k posts fit the bounds, the rest are
+    filled with the best posts at the smallest widening of the bounds.
     '''
     load_dotenv()
     bound_increase = int(os.getenv("BOUND_INCREASE"))
-    
+
     headers = get_oauth_headers()
 
-    # Get the first set of posts, and rank them, keeping track of all posts gathered
-    posts, final_ids = accumulate_posts(subreddits, headers=headers)
-    total_posts = pandas.DataFrame()
-    total_posts = pandas.concat([total_posts, posts], ignore_index=True)
-    posts = rank_posts(posts, bounds)
-
-    # If no posts meet criteria, paginate through posts until there are no 
-    # more results to get, keeping track of total posts
-    while posts.shape[0] == 0:
-        posts, new_final_ids = accumulate_posts(subreddits, headers=headers, final_ids=final_ids)
-        total_posts = pandas.concat([total_posts, posts], ignore_index=True)
-        if posts.empty:
-            break
-        posts = rank_posts(posts, bounds)
-        final_ids = new_final_ids
-
-    # If no posts can be found with the current bounds, 
-    # gradually widen them until one is.
-    current_bound_increase = bound_increase
-    while posts.shape[0] == 0:
-        running_total = total_posts.copy()
-        posts = rank_posts(running_total, bounds, current_bound_increase)
-        current_bound_increase = current_bound_increase + bound_increase
-        if current_bound_increase > 300:
+    heap = []
+    seen = 0
+    pushed = set()
+    award_cap = 0
+    total_posts = []
+    final_ids = None
+    while final_ids is None or any(final_id != 'end' for final_id in final_ids):
+        posts, final_ids = accumulate_posts(subreddits, headers=headers, final_ids=final_ids,
+                                            group_size=group_size)
+        if len(posts) == 0:
             break
+        total_posts += posts
+        award_cap = max(award_cap, max(post.num_awards for post in posts))
+
+        # Keep the best k posts, letting earlier posts win ties like a stable sort
+        for post in rank_posts(posts, bounds):
+            # Listings can shift between pages and repeat a post
+            if post.id in pushed:
+                continue
+            pushed.add(post.id)
+            entry = (post.postability, -seen, post)
+            seen += 1
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, entry)
+
+        # Stop paginating listings that can't have anything better than the worst kept post
+        if len(heap) == k:
+            limits = unseen_bound(posts, final_ids, bounds, award_cap)
+            final_ids = [final_id if limit > heap[0][0] else 'end'
+                         for final_id, limit in zip(final_ids, limits)]
+
+    top_posts = [post for _, _, post in sorted(heap, key=lambda entry: entry[:2], reverse=True)]
+
+    # If too few posts can be found with the current bounds, 
+    # fill up with the best posts at the smallest widening of them.
+    if len(top_posts) < k and len(total_posts) != 0:
+        kept = {post.id for post in top_posts}
+        for post in rank_widened_posts(total_posts, bounds, bound_increase):
+            if len(top_posts) == k:
+                break
+            if post.id not in kept:
+                top_posts.append(post)
+                kept.add(post.id)
+
+    return top_posts, headers
+
+
+def get_top_post(subreddits, bounds, group_size=1):
+    '''
+    Get the most postable reddit post (and comment if applicable) from the subreddit(s) given
+
+    group_size above one fetches the subreddits through combined listings, see accumulate_posts
+    '''
+    posts, headers = get_top_k_posts(subreddits, bounds, k=1, group_size=group_size)
 
-    # If no post is found STILL, throw an exception and terminate
-    if posts.shape[0] == 0:
+    # If no post is found, throw an exception and terminate
+    if len(posts) == 0:
         raise Exception("No posts could be found")
     
-    top_post = posts.iloc[0]
+    top_post = posts[0]
 
     return top_post, headers
 
@@ -235,4 +476,5 @@ if __name__ == "__main__":
 
     top_post, _ = get_top_post(subreddits, "5,120")
 
-    print(top_post['title'], "\n\n", top_post['body'])
\ No newline at end of file
+    print(top_post['title'], "\n\n", top_post['body'])
+    print(get_client().stats())
\ No newline at end of file
@@ -0,0 +1,116 @@
+from dataclasses import dataclass, field, replace
+
+
+@dataclass(slots=True)
+class Record:
+    '''
+    Base class for scraped records, which can also be read and written like a
+    dictionary (post['title']) so the rest of the pipeline works with either.
+    '''
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        '''
+        Return a field, or default if the record doesn't have it.
+        '''
+        return getattr(self, key, default)
+
+    def copy(self):
+        '''
+        Return a shallow copy of the record.
+        '''
+        return replace(self)
+
+
+def award_urls(data):
+    '''
+    Given the data of a post or comment, return the icon urls of its awards.
+    '''
+    awards = []
+    if data['total_awards_received'] != 0:
+        for award in data['all_awardings']:
+            awards.append(award['icon_url'])
+
+    return awards
+
+
+@dataclass(slots=True)
+class Post(Record):
+    '''
+    A scraped Reddit post.
+    '''
+    title: str
+    body: str
+    author: str
+    id: str
+    upvotes: int
+    num_awards: int
+    num_comments: int
+    url: str
+    awards: list = field(default_factory=list)
+    nsfw: bool = False
+    subreddit: str = ''
+    postability: float = 0.0
+    widen: int = 0
+
+    @classmethod
+    def from_listing(cls, data):
+        '''
+        Create a post from the data of a listing child.
+        '''
+        return cls(
+            title=data['title'],
+            body=data['selftext'],
+            author=data['author'],
+            id=data['id'],
+            upvotes=data['ups'],
+            num_awards=data['total_awards_received'],
+            num_comments=data['num_comments'],
+            url=data['url'],
+            awards=award_urls(data),
+            nsfw=data['over_18'],
+            subreddit=data['subreddit'],
+        )
+
+
+@dataclass(slots=True)
+class Comment(Record):
+    '''
+    A scraped Reddit comment.
+    '''
+    body: str
+    author: str
+    upvotes: int
+    num_awards: int
+    id: str
+    awards: list = field(default_factory=list)
+    avatar: str = ''
+    postability: float = 0.0
+    widen: int = 0
+
+    @classmethod
+    def from_listing(cls, data):
+        '''
+        Create a comment from the data of a listing child.
+        '''
+        return cls(
+            body=data['body'],
+            author=data['author'],
+            upvotes=data['ups'],
+            num_awards=data['total_awards_received'],
+            id=data['name'],
+            awards=award_urls(data),
+        )
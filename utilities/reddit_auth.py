@@ -0,0 +1,120 @@
+from utilities.reddit_client import get_client
+from utilities.file_lock import FileLock, atomic_write
+from dotenv import load_dotenv
+import threading
+import requests
+import hashlib
+import json
+import time
+import os
+
+
+USER_AGENT = 'Content_Scraper/0.1'
+# Tokens are refreshed this many seconds before they expire
+REFRESH_MARGIN = 5 * 60
+
+_token = None
+_token_lock = threading.Lock()
+
+
+def get_account():
+    '''
+    Return a fingerprint of the Reddit app and user in .env, so a cached token
+    is never used for a different account.
+    '''
+    client_id = os.getenv("CLIENT_ID")
+    username = os.getenv("REDDIT_USERNAME")
+
+    return hashlib.sha256(f"{client_id}:{username}".encode()).hexdigest()
+
+
+def is_fresh(token, account):
+    '''
+    Return True if a cached token belongs to the account and isn't about to expire.
+    '''
+    return isinstance(token, dict) and token.get('account') == account and \
+        token.get('expires_at', 0) - REFRESH_MARGIN > time.time()
+
+
+def read_token(path):
+    '''
+    Read a cached token from disk, returning None if there isn't a valid one.
+    '''
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_token(path, token):
+    '''
+    Write a token to disk atomically so other processes never read half of it.
+    '''
+    # Only the current user should be able to read the token
+    atomic_write(path, json.dumps(token), mode=0o600)
+
+
+def request_token(account):
+    '''
+    Using the environment variables saved in .env, get a new OAuth token
+    from Reddit along with the time it expires.
+    '''
+    client_id = os.getenv("CLIENT_ID")
+    secret_token = os.getenv("SECRET_TOKEN")
+    username = os.getenv("REDDIT_USERNAME")
+    password = os.getenv("REDDIT_PASSWORD")
+
+    auth = requests.auth.HTTPBasicAuth(client_id, secret_token)
+
+    data = {'grant_type': 'password',
+        'username': username,
+        'password': password}
+
+    headers = {'User-Agent': USER_AGENT}
+
+    requested_at = time.time()
+    r = get_client().post('https://www.reddit.com/api/v1/access_token',
+                    auth=auth, data=data, headers=headers)
+
+    if r is None or r.status_code != 200:
+        print(r)
+        raise Exception("Couldn't get a Reddit OAuth token")
+
+    response = r.json()
+
+    return {
+        'access_token': response['access_token'],
+        'expires_at': requested_at + response.get('expires_in', 3600),
+        'account': account,
+    }
+
+
+def get_oauth_headers():
+    '''
+    Return OAuth headers for the Reddit API, reusing the token cached on disk.
+
+    The token is kept in the file set by TOKEN_CACHE in .env (.reddit_token.json by
+    default) and is only requested again shortly before it expires. A lock file next
+    to it makes sure concurrent processes request at most one new token.
+    '''
+    global _token
+    load_dotenv()
+    path = os.getenv("TOKEN_CACHE", ".reddit_token.json")
+    account = get_account()
+
+    with _token_lock:
+        if not is_fresh(_token, account):
+            _token = read_token(path)
+
+        if not is_fresh(_token, account):
+            with FileLock(path + ".lock"):
+                # Another process may have refreshed the token while we waited
+                _token = read_token(path)
+                if not is_fresh(_token, account):
+                    _token = request_token(account)
+                    write_token(path, _token)
+
+        token = _token['access_token']
+
+    return {'User-Agent': USER_AGENT, 'Authorization': f"bearer {token}"}
@@ -0,0 +1,177 @@
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+import threading
+import requests
+import random
+import time
+import os
+
+
+# Default number of requests allowed in flight at once
+MAX_CONCURRENCY = 16
+# How many times a throttled or failed request is retried
+MAX_RETRIES = 5
+# The base delay in seconds for exponential backoff between retries
+BACKOFF = 1.0
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class RedditClient:
+    '''
+    A pooled HTTP client for the Reddit API shared by the collectors.
+
+    It reads the X-Ratelimit-Remaining and X-Ratelimit-Reset headers of every
+    response and never lets more requests be in flight than the remaining budget
+    allows, waiting for the window to reset once it runs out. Throttled (429) and
+    server error responses are retried with jittered exponential backoff.
+    '''
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, max_retries=MAX_RETRIES, backoff=BACKOFF):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_concurrency)
+        self.session.mount("https://", adapter)
+
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.remaining = None
+        self.reset_at = 0
+
+        self.counters = {'requests': 0, 'throttled': 0, 'retries': 0, 'failures': 0}
+        self.latency_total = 0
+        self.latency_max = 0
+
+    def allowed_concurrency(self):
+        '''
+        Return how many requests may be in flight given the remaining rate limit budget.
+        '''
+        if self.remaining is None or time.time() >= self.reset_at:
+            return self.max_concurrency
+
+        return max(0, min(self.max_concurrency, int(self.remaining)))
+
+    def acquire(self):
+        '''
+        Wait until a request can be sent without going over the rate limit.
+        '''
+        with self.condition:
+            while True:
+                if self.in_flight < self.allowed_concurrency():
+                    self.in_flight += 1
+                    if self.remaining is not None:
+                        self.remaining -= 1
+                    return
+
+                # Wait for a request to finish, or for the window to reset if out of budget
+                if self.allowed_concurrency() == 0:
+                    self.condition.wait(max(0.05, self.reset_at - time.time()))
+                else:
+                    self.condition.wait()
+
+    def release(self, response, latency):
+        '''
+        Record a finished request and update the budget from its rate limit headers.
+        '''
+        with self.condition:
+            self.in_flight -= 1
+            self.counters['requests'] += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+            if response is not None and 'X-Ratelimit-Remaining' in response.headers:
+                # Requests still in flight will use up part of what's left
+                remaining = float(response.headers['X-Ratelimit-Remaining'])
+                self.remaining = remaining - self.in_flight
+                self.reset_at = time.time() + float(response.headers.get('X-Ratelimit-Reset', 60))
+
+            self.condition.notify_all()
+
+    def retry_delay(self, response, attempt):
+        '''
+        Return how long to wait before retrying, with full jitter so that
+        concurrent requests don't all retry at the same moment.
+        '''
+        if response is not None and 'Retry-After' in response.headers:
+            try:
+                return float(response.headers['Retry-After']) + random.uniform(0, self.backoff)
+            except ValueError:
+                pass
+
+        return random.uniform(0, self.backoff * 2**attempt)
+
+    def request(self, method, url, **kwargs):
+        '''
+        Send a request, retrying throttled and failed ones.
+        Returns the last response, or None if the request never got one.
+        '''
+        kwargs.setdefault('timeout', 30)
+        response = None
+
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                with self.condition:
+                    self.counters['retries'] += 1
+                time.sleep(self.retry_delay(response, attempt - 1))
+
+            self.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                print(e)
+                response = None
+            finally:
+                self.release(response, time.perf_counter() - start)
+
+            if response is not None and response.status_code == 429:
+                with self.condition:
+                    self.counters['throttled'] += 1
+            elif response is not None and response.status_code < 500:
+                return response
+
+        with self.condition:
+            self.counters['failures'] += 1
+
+        return response
+
+    def get(self, url, **kwargs):
+        '''
+        Send a GET request through request().
+        '''
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        '''
+        Send a POST request through request().
+        '''
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        '''
+        Return the request, throttle, retry and failure counters along with
+        the mean and max request latency in seconds.
+        '''
+        with self.condition:
+            stats = dict(self.counters)
+            stats['mean_latency'] = self.latency_total / max(1, self.counters['requests'])
+            stats['max_latency'] = self.latency_max
+
+        return stats
+
+
+def get_client():
+    '''
+    Return the Reddit client shared by everything in the process, creating it on first use.
+    REDDIT_CONCURRENCY in .env optionally sets how many requests may be in flight at once.
+    '''
+    global _client
+    with _client_lock:
+        if _client is None:
+            load_dotenv()
+            _client = RedditClient(max_concurrency=int(os.getenv("REDDIT_CONCURRENCY", MAX_CONCURRENCY)))
+
+    return _client
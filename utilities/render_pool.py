@@ -0,0 +1,180 @@
+from selenium.common.exceptions import WebDriverException
+from concurrent.futures import ThreadPoolExecutor
+from selenium import webdriver
+from dotenv import load_dotenv
+import threading
+import atexit
+import base64
+import queue
+import math
+import time
+import os
+
+
+# Default number of warm browser pages kept open
+POOL_SIZE = 2
+# Browser window size, the same as the html2image default
+WINDOW_SIZE = (1920, 1080)
+# How many times a render is retried on a fresh page after the browser crashes
+MAX_RESTARTS = 2
+# How long to wait for the images in a card to load, in milliseconds
+IMAGE_TIMEOUT = 10000
+
+# Resolves once every image in the document has loaded or failed, or the timeout passes
+WAIT_FOR_IMAGES = f'''
+Promise.race([
+    Promise.all(Array.from(document.images).map(image => image.complete ? null :
+        new Promise(resolve => {{ image.onload = image.onerror = resolve; }}))),
+    new Promise(resolve => setTimeout(resolve, {IMAGE_TIMEOUT}))
+]).then(() => {{
+    const rect = document.body.getBoundingClientRect();
+    return [rect.right, Math.max(rect.bottom, document.documentElement.scrollHeight)];
+}})
+'''
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class RenderPool:
+    '''
+    A pool of long-lived headless Chrome pages that render HTML cards to PNG.
+
+    Chrome is started once per page instead of once per screenshot. Each render
+    swaps the document into a warm page and captures it over the DevTools
+    protocol with a transparent background. At most `size` renders run at once,
+    and a page that crashes is replaced with a new one before the render is retried.
+    '''
+    def __init__(self, size=POOL_SIZE, window_size=WINDOW_SIZE):
+        self.size = size
+        self.window_size = window_size
+        self.pages = queue.Queue()
+        self.drivers = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+        for _ in range(size):
+            self.pages.put(self.start_page())
+
+    def start_page(self):
+        '''
+        Launch a headless Chrome and get its page ready for rendering.
+        '''
+        options = webdriver.ChromeOptions()
+        options.add_argument("--headless=new")
+        options.add_argument("--hide-scrollbars")
+        options.add_argument("--force-device-scale-factor=1")
+        options.add_argument(f"--window-size={self.window_size[0]},{self.window_size[1]}")
+
+        driver = webdriver.Chrome(options=options)
+        driver.execute_cdp_cmd("Page.enable", {})
+        driver.execute_cdp_cmd("Emulation.setDefaultBackgroundColorOverride",
+                               {'color': {'r': 0, 'g': 0, 'b': 0, 'a': 0}})
+
+        with self.lock:
+            self.drivers.append(driver)
+
+        return driver
+
+    def restart_page(self, driver):
+        '''
+        Quit a crashed browser and return a new one in its place.
+        '''
+        with self.lock:
+            if driver in self.drivers:
+                self.drivers.remove(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+        return self.start_page()
+
+    def capture(self, driver, document):
+        '''
+        Load an HTML document into a page and return a PNG screenshot of it.
+        '''
+        frame_id = driver.execute_cdp_cmd("Page.getFrameTree", {})['frameTree']['frame']['id']
+        driver.execute_cdp_cmd("Page.setDocumentContent", {'frameId': frame_id, 'html': document})
+
+        size = driver.execute_cdp_cmd("Runtime.evaluate", {'expression': WAIT_FOR_IMAGES,
+                                                           'awaitPromise': True,
+                                                           'returnByValue': True})['result']['value']
+
+        # Clip to the card so the screenshot isn't mostly empty space
+        clip = {'x': 0, 'y': 0, 'width': math.ceil(size[0]), 'height': math.ceil(size[1]), 'scale': 1}
+        screenshot = driver.execute_cdp_cmd("Page.captureScreenshot", {'format': 'png',
+                                                                       'clip': clip,
+                                                                       'captureBeyondViewport': True})
+
+        return base64.b64decode(screenshot['data'])
+
+    def render(self, document):
+        '''
+        Render an HTML document on the next free page and return the PNG bytes.
+        '''
+        if self.closed:
+            raise Exception("The render pool has been closed")
+
+        driver = self.pages.get()
+        try:
+            for attempt in range(MAX_RESTARTS + 1):
+                try:
+                    return self.capture(driver, document)
+                except WebDriverException as e:
+                    if attempt == MAX_RESTARTS:
+                        raise
+                    print(e)
+                    driver = self.restart_page(driver)
+        finally:
+            self.pages.put(driver)
+
+    def render_many(self, documents):
+        '''
+        Render a list of HTML documents across the pool, returning PNG bytes in the same order.
+        '''
+        if len(documents) == 0:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(self.size, len(documents))) as executor:
+            # list() waits for every document and raises the first error
+            return list(executor.map(self.render, documents))
+
+    def close(self):
+        '''
+        Quit every browser in the pool.
+        '''
+        with self.lock:
+            self.closed = True
+            drivers, self.drivers = self.drivers, []
+
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+
+
+def get_render_pool():
+    '''
+    Return the render pool shared by everything in the process, starting it on first use.
+    RENDER_POOL_SIZE in .env optionally sets how many browser pages are kept warm.
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            load_dotenv()
+            _pool = RenderPool(size=int(os.getenv("RENDER_POOL_SIZE", POOL_SIZE)))
+            atexit.register(_pool.close)
+
+    return _pool
+
+
+if __name__ == "__main__":
+    pool = get_render_pool()
+    document = "<body style=\"font-family: Verdana, sans-serif;\"><p style=\"color: white;\">Hello</p></body>"
+
+    for i in range(3):
+        start = time.perf_counter()
+        pool.render(document)
+        print(f"render {i + 1}: {(time.perf_counter() - start) * 1000:.0f}ms")
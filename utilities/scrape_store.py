@@ -0,0 +1,184 @@
+from dotenv import load_dotenv
+import threading
+import hashlib
+import sqlite3
+import json
+import time
+import os
+
+
+# How long the scores of a post or comment are trusted before they are refreshed
+SCORE_TTL = 10 * 60
+# How long a listing page is served before it is fetched again. This matches SCORE_TTL,
+# since refreshing the scores on a page takes about as many requests as fetching it again
+PAGE_TTL = SCORE_TTL
+# Anything older than this is deleted when the store is opened
+MAX_AGE = 2 * 24 * 60 * 60
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def cursor_key(cursor):
+    '''
+    Turn a pagination cursor into the key its page is stored under.
+    Lists of comment IDs (for morechildren) are hashed so the key stays short.
+    '''
+    if cursor is None:
+        return ''
+    if isinstance(cursor, (list, tuple)):
+        return hashlib.sha1(",".join(cursor).encode()).hexdigest()
+
+    return str(cursor)
+
+
+class ScrapeStore:
+    '''
+    A local SQLite store of scraped listing pages and the posts and comments in them,
+    keyed by Reddit fullname. Pages and things carry the time they were fetched and
+    how long they stay fresh, so repeated runs only fetch new or stale pages.
+    '''
+    def __init__(self, path, page_ttl=PAGE_TTL, score_ttl=SCORE_TTL):
+        self.path = path
+        self.page_ttl = page_ttl
+        self.score_ttl = score_ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS pages (
+                listing TEXT NOT NULL,
+                cursor TEXT NOT NULL,
+                children TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                ttl REAL NOT NULL,
+                PRIMARY KEY (listing, cursor)
+            );
+            CREATE TABLE IF NOT EXISTS things (
+                fullname TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                ttl REAL NOT NULL
+            );
+        ''')
+        self.prune(MAX_AGE)
+
+    def get_page(self, listing, cursor):
+        '''
+        Return the children of a stored listing page with the latest data for each
+        post or comment, or None if the page was never fetched or has expired.
+        '''
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT children, fetched_at, ttl FROM pages WHERE listing = ? AND cursor = ?",
+                (listing, cursor_key(cursor))).fetchone()
+        if row is None or row[1] + row[2] < time.time():
+            return None
+
+        children = json.loads(row[0])
+        things = self.get_things([child['data']['name'] for child in children if child['kind'] != 'more'])
+        for child in children:
+            if child['kind'] != 'more' and child['data']['name'] in things:
+                child['data'] = things[child['data']['name']]
+
+        return children
+
+    def put_page(self, listing, cursor, children):
+        '''
+        Save a freshly fetched listing page along with the posts or comments in it.
+        '''
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                (listing, cursor_key(cursor), json.dumps(children), now, self.page_ttl))
+        self.update_things(children)
+
+    def get_things(self, fullnames):
+        '''
+        Given a list of fullnames, return a dictionary of the stored data for each.
+        '''
+        things = {}
+        with self.lock:
+            for i in range(0, len(fullnames), 500):
+                chunk = fullnames[i:i + 500]
+                rows = self.connection.execute(
+                    f"SELECT fullname, data FROM things WHERE fullname IN ({','.join('?' * len(chunk))})",
+                    chunk).fetchall()
+                for fullname, data in rows:
+                    things[fullname] = json.loads(data)
+
+        return things
+
+    def update_things(self, children):
+        '''
+        Save the latest data of the posts or comments in a list of listing children.
+        '''
+        now = time.time()
+        rows = [(child['data']['name'], json.dumps(child['data']), now, self.score_ttl)
+                for child in children if child['kind'] != 'more']
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO things VALUES (?, ?, ?, ?)", rows)
+
+    def stale_fullnames(self, fullnames):
+        '''
+        Given a list of fullnames, return the ones whose scores have expired.
+        '''
+        now = time.time()
+        fresh = set()
+        with self.lock:
+            for i in range(0, len(fullnames), 500):
+                chunk = fullnames[i:i + 500]
+                rows = self.connection.execute(
+                    f"SELECT fullname FROM things WHERE fetched_at + ttl >= ? AND fullname IN ({','.join('?' * len(chunk))})",
+                    [now, *chunk]).fetchall()
+                fresh.update(row[0] for row in rows)
+
+        return [fullname for fullname in fullnames if fullname not in fresh]
+
+    def prune(self, max_age):
+        '''
+        Delete pages and things fetched more than max_age seconds ago.
+        '''
+        cutoff = time.time() - max_age
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM pages WHERE fetched_at < ?", (cutoff,))
+            self.connection.execute("DELETE FROM things WHERE fetched_at < ?", (cutoff,))
+
+    def close(self):
+        '''
+        Close the database connection.
+        '''
+        with self.lock:
+            self.connection.close()
+
+
+def get_store():
+    '''
+    Return the scrape store shared by the collectors, opening it on first use.
+    The database file is set by SCRAPE_STORE in .env and defaults to scrape_store.db,
+    and PAGE_TTL / SCORE_TTL optionally override how many seconds entries stay fresh.
+    SCORE_TTL defaults to PAGE_TTL when only that is set.
+    '''
+    global _store
+    with _store_lock:
+        if _store is None:
+            load_dotenv()
+            page_ttl = float(os.getenv("PAGE_TTL", PAGE_TTL))
+            _store = ScrapeStore(os.getenv("SCRAPE_STORE", "scrape_store.db"),
+                                 page_ttl=page_ttl,
+                                 score_ttl=float(os.getenv("SCORE_TTL", page_ttl)))
+
+    return _store
+
+
+def refresh_children(pages, refreshed):
+    '''
+    Given listing pages and a list of refreshed listing children, swap the new data
+    into the pages in place.
+    '''
+    latest = {child['data']['name']: child['data'] for child in refreshed}
+    for page in pages:
+        for child in page:
+            if child['kind'] != 'more' and child['data']['name'] in latest:
+                child['data'] = latest[child['data']['name']]
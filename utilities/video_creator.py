@@ -1,98 +1,298 @@
-from moviepy.editor import *
-from moviepy.video.fx.all import crop
+from utilities.background_library import get_background_library, crop_box, OUTPUT_SIZE
+from concurrent.futures import ProcessPoolExecutor
+from utilities.voiceover_creator import Voiceover, VOICE
 from dotenv import load_dotenv
+from PIL import Image
+import imageio_ffmpeg
 import numpy as np
-import random
+import subprocess
+import tempfile
 import math
+import wave
 import os
 
 
-def get_video(folder):
+# Sample rate of the voiceover track, the same as the voices so they don't need resampling
+TRACK_RATE = int(VOICE['SampleRate'])
+# Sample rate of the finished video's audio
+AUDIO_RATE = 44100
+# Seconds of silence after each voiceover
+GAP_SECONDS = 1
+# Encoder settings of the finished video, and of each segment of a parallel render
+VIDEO_CODEC = ["-c:v", "libx264", "-preset", "ultrafast"]
+# ffmpeg input options for the voiceover track piped in on stdin, and its encoder settings
+TRACK_INPUT = ["-f", "s16le", "-ar", str(TRACK_RATE), "-ac", "1", "-i", "pipe:0"]
+AUDIO_CODEC = ["-c:a", "aac", "-ar", str(AUDIO_RATE), "-ac", "2"]
+# Shortest segment a parallel render splits the video into, in seconds
+MIN_SEGMENT_SECONDS = 2
+
+
+def read_voiceovers(filename, comment, save_path):
     '''
-    Returns a random video path from a folder of video files
+    Return Voiceovers for filename.wav and, if there is a comment, filename_comment.wav.
+    Their durations aren't read, as the track is timed by the decoded samples.
     '''
-    videos = os.listdir(folder)
-    video = random.sample(videos, 1)
+    names = [filename + ".wav"] + ([filename + "_comment" + ".wav"] if comment else [])
 
-    return video
+    return [Voiceover(os.path.join(save_path, name)) for name in names]
 
 
-def create_silence(save_path):
+def decode_audio(path):
     '''
-    Given a directory and filename, create a one second audioclip of silence named "silence.mp3"
-    
-    Note: This isn't the best way of adding a one second silence buffer
-    but nothing else seems to work, may figure it out later.
+    Decode a voiceover file to mono 16 bit samples at TRACK_RATE. Wav files already
+    in that format are read directly, anything else is decoded with ffmpeg.
     '''
-    make_frame = lambda t: 2*[ 0 * t ]
-    clip = AudioClip(make_frame, duration=1).set_fps(24000)
-    clip.write_audiofile(os.path.join(save_path, "silence.mp3"))
+    if path.endswith(".wav"):
+        with wave.open(path, "rb") as wav:
+            if (wav.getnchannels(), wav.getsampwidth(), wav.getframerate()) == (1, 2, TRACK_RATE):
+                return np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+
+    result = subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-loglevel", "error", "-i", path,
+                             "-f", "s16le", "-ac", "1", "-ar", str(TRACK_RATE), "-"], capture_output=True)
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg failed to decode {path}: {result.stderr.decode(errors='replace')}")
+
+    return np.frombuffer(result.stdout, dtype=np.int16)
+
+
+def voiceover_track(voiceovers):
+    '''
+    Assemble the audio of the video in memory from the decoded voiceovers, each followed
+    by GAP_SECONDS of silence, so the track lasts exactly as long as the video.
+    Returns the mono 16 bit samples at TRACK_RATE and the (start, end) time of each
+    voiceover in the track, taken from its samples, for scheduling the overlays.
+    '''
+    segments = [decode_audio(voiceover.path) for voiceover in voiceovers]
+    gap = round(GAP_SECONDS * TRACK_RATE)
+
+    # The silence is whatever isn't written over
+    track = np.zeros(sum(len(segment) for segment in segments) + gap * len(segments), dtype=np.int16)
+    timings = []
+    position = 0
+    for segment in segments:
+        track[position:position + len(segment)] = segment
+        timings.append((position / TRACK_RATE, (position + len(segment)) / TRACK_RATE))
+        position += len(segment) + gap
 
+    return track, timings
 
-def create_video(filename, comment=False):
+
+def render_moviepy(output, background, start_time, length, overlays, audio):
     '''
-    Given a post and filename, create a TikTok / Instagram Reels style video.
+    Composite the video frame by frame in Python with moviepy.
     '''
+    from moviepy.editor import VideoFileClip, ImageClip, CompositeVideoClip
+    from moviepy.audio.AudioClip import AudioArrayClip
+    from moviepy.video.fx.all import crop
+
+    # moviepy takes stereo samples from -1 to 1
+    voiceover = AudioArrayClip(np.repeat(audio[:, None] / 32768, 2, axis=1), fps=TRACK_RATE)
+
+    background_clip = VideoFileClip(background.path, audio=False)
+    background_clip = background_clip.subclip(start_time, start_time + length)
+
+    # Crop it to be aspect ratio 9x16 for reels content, unless it's a proxy that already is
+    if tuple(background_clip.size) != OUTPUT_SIZE:
+        x1, x2 = crop_box(background_clip.size)
+        background_clip = crop(background_clip, x1=x1, y1=0, x2=x2, y2=background_clip.size[1])
+        background_clip = background_clip.resize(height=OUTPUT_SIZE[1], width=OUTPUT_SIZE[0])
+
+    clips = [background_clip]
+    for image, start, end in overlays:
+        clips.append(ImageClip(image).set_start(start).set_duration(end - start).set_pos(("center", "center")))
+
+    final_clip = CompositeVideoClip(clips).set_audio(voiceover)
+    final_clip.write_videofile(output, temp_audiofile=os.path.splitext(output)[0] + "_temp.mp3", codec='libx264', ffmpeg_params=['-vf', 'format=yuv420p'], preset='ultrafast')
+
+    for clip in clips:
+        clip.close()
+    final_clip.close()
+
+
+def save_overlay(image, directory, name):
+    '''
+    Return a path ffmpeg can read an overlay from, writing it to a PNG in
+    directory if it's an RGBA array.
+    '''
+    if isinstance(image, str):
+        return image
+
+    path = os.path.join(directory, name + ".png")
+    # The file is only read once, so don't spend time compressing it
+    Image.fromarray(image).save(path, compress_level=1)
+
+    return path
+
+
+def video_graph(background, overlays, offset=0):
+    '''
+    Return the filtergraph that brings the background (input 0) to the output size and
+    overlays the cards (inputs 1 onwards) during their (start, end) windows, shifted
+    back by offset seconds for a segment that starts partway through. Its output is [video].
+    '''
+    # Proxies are already cropped and scaled, so their frames go straight to the overlays
+    if (background.width, background.height) == OUTPUT_SIZE:
+        graph = ["[0:v]setsar=1[v0]"]
+    else:
+        x1, x2 = crop_box((background.width, background.height))
+        graph = [f"[0:v]crop={x2 - x1}:ih:{x1}:0,scale={OUTPUT_SIZE[0]}:{OUTPUT_SIZE[1]},setsar=1[v0]"]
+    for i, (_, start, end) in enumerate(overlays):
+        graph.append(f"[v{i}][{i + 1}:v]overlay=(W-w)/2:(H-h)/2:"
+                     f"enable='gte(t,{start - offset})*lt(t,{end - offset})'[v{i + 1}]")
+    graph.append(f"[v{len(overlays)}]format=yuv420p[video]")
+
+    return graph
+
+
+def run_ffmpeg(command, audio=None):
+    '''
+    Run an ffmpeg command, feeding it the samples of the voiceover track on stdin if given,
+    and raise an exception with its error output if it fails.
+    '''
+    # Without a track, keep ffmpeg from reading keypresses off the terminal
+    stdin = {'stdin': subprocess.DEVNULL} if audio is None else {'input': audio.tobytes()}
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, **stdin)
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg failed to render {command[-1]}: {result.stderr.decode(errors='replace')}")
+
+
+def render_ffmpeg(output, background, start_time, length, overlays, audio):
+    '''
+    Render the video with a single ffmpeg filtergraph, so no frames pass through Python.
+    The background is seeked, cropped and scaled, the cards are overlaid during their
+    (start, end) windows and the voiceover track is encoded straight from memory.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        command = [imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error",
+                   "-ss", str(start_time), "-t", str(length), "-an", "-i", background.path]
+        for i, (image, _, _) in enumerate(overlays):
+            command += ["-i", save_overlay(image, directory, f"overlay{i}")]
+        command += TRACK_INPUT
+
+        command += ["-filter_complex", ";".join(video_graph(background, overlays)), "-map", "[video]",
+                    "-map", f"{len(overlays) + 1}:a", *VIDEO_CODEC, *AUDIO_CODEC, "-t", str(length), output]
+
+        run_ffmpeg(command, audio)
+
+
+def segment_frames(background, start_time, length, workers):
+    '''
+    Split the frames of the video into up to one (first, last) range per worker.
+    Each cut is moved back to the background's closest keyframe when one is near,
+    so every segment starts decoding without skipping frames, and no segment is
+    shorter than MIN_SEGMENT_SECONDS.
+    '''
+    fps = background.fps
+    # ffmpeg -t keeps every frame that starts before the end, so a partial last frame counts
+    total = math.ceil(length * fps - 1e-9)
+    count = max(1, min(workers, int(length // MIN_SEGMENT_SECONDS)))
+
+    cuts = [0]
+    for k in range(1, count):
+        target = k * length / count
+        keyframe = background.keyframe_before(start_time + target) - start_time
+        # Sparse keyframes would make the segments uneven, so cut between them instead
+        cut = round((keyframe if target - keyframe < length / count / 2 else target) * fps)
+        if cut - cuts[-1] >= MIN_SEGMENT_SECONDS * fps and total - cut >= MIN_SEGMENT_SECONDS * fps:
+            cuts.append(cut)
+    cuts.append(total)
+
+    return list(zip(cuts, cuts[1:]))
+
+
+def render_parallel(output, background, start_time, length, overlays, audio):
+    '''
+    Render the video in segments at the same time, one per worker process, then join
+    them with the concat demuxer without encoding them again. The segments are cut on
+    frame boundaries and the voiceover track is only added once the video is joined, so there
+    are no gaps or drift at the seams. RENDER_WORKERS in .env sets how many segments
+    are rendered at once and defaults to the number of CPU cores.
+    '''
+    workers = int(os.getenv('RENDER_WORKERS', os.cpu_count() or 1))
+    # Segments can only be cut on frame boundaries if the frame rate is known
+    segments = segment_frames(background, start_time, length, workers) if background.fps else []
+    if len(segments) < 2:
+        return render_ffmpeg(output, background, start_time, length, overlays, audio)
+
+    # Split the cores between the encoders so they don't fight over them
+    threads = max(1, (os.cpu_count() or 1) // len(segments))
+
+    with tempfile.TemporaryDirectory() as directory:
+        images = [save_overlay(image, directory, f"overlay{i}") for i, (image, _, _) in enumerate(overlays)]
+
+        commands = []
+        paths = []
+        for i, (first, last) in enumerate(segments):
+            offset = first / background.fps
+            paths.append(os.path.join(directory, f"segment{i}.mp4"))
+            command = [imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error", "-ss", f"{start_time + offset:.6f}",
+                       "-t", f"{(last - first + 1) / background.fps:.6f}", "-an", "-i", background.path]
+            for image in images:
+                command += ["-i", image]
+            command += ["-filter_complex", ";".join(video_graph(background, overlays, offset)), "-map", "[video]",
+                        *VIDEO_CODEC, "-threads", str(threads), "-frames:v", str(last - first), paths[-1]]
+            commands.append(command)
+
+        with ProcessPoolExecutor(max_workers=len(segments)) as executor:
+            # list() waits for every segment and raises the first error
+            list(executor.map(run_ffmpeg, commands))
+
+        segment_list = os.path.join(directory, "segments.txt")
+        with open(segment_list, "w") as f:
+            f.writelines(f"file '{path}'\n" for path in paths)
+
+        command = [imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error",
+                   "-f", "concat", "-safe", "0", "-i", segment_list, *TRACK_INPUT,
+                   "-map", "0:v", "-map", "1:a", "-c:v", "copy", *AUDIO_CODEC, "-t", str(length), output]
+
+        run_ffmpeg(command, audio)
+
+
+# The backends VIDEO_BACKEND can choose from
+VIDEO_BACKENDS = {'ffmpeg': render_ffmpeg, 'parallel': render_parallel, 'moviepy': render_moviepy}
+
+
+def create_video(filename, post_image, comment_image=None, voiceovers=None, backend=None):
+    '''
+    Given a filename and the RGBA arrays (or image paths) of the post image and
+    optionally the comment image, create a TikTok / Instagram Reels style video.
+    voiceovers are the ones returned by create_voiceover, which give the audio files.
+    Without them filename.wav and filename_comment.wav are used. The voiceovers are
+    joined into one track in memory, and the (start, end) time of each in the
+    video is returned.
+
+    The backend renders the video, either "ffmpeg" (one native filtergraph), "parallel"
+    (the same filtergraph over segments of the video in several processes) or "moviepy"
+    (frame by frame in Python). It defaults to VIDEO_BACKEND in .env, or "ffmpeg".
+    '''
+    comment = comment_image is not None
+
     load_dotenv()
     save_path = os.getenv('SAVE_PATH')
     background_folder = os.getenv('BACKGROUND_VIDEO_DIR')
+    backend = backend or os.getenv('VIDEO_BACKEND', 'ffmpeg')
+    if backend not in VIDEO_BACKENDS:
+        raise Exception(f"Unknown video backend {backend}")
 
-    # Open voiceover and get its length
-    voiceover = AudioFileClip(os.path.join(save_path, filename + ".mp3"))
-    voiceover_length = voiceover.duration
+    if voiceovers is None:
+        voiceovers = read_voiceovers(filename, comment, save_path)
+    audio, timings = voiceover_track(voiceovers[:2 if comment else 1])
+    length = len(audio) / TRACK_RATE
 
-    # Do the same if a comment exists and concatenate clips
-    if comment:
-        voiceover_comment = AudioFileClip(os.path.join(save_path, filename + "_comment" + ".mp3"))
-        voiceover_comment_length = voiceover_comment.duration
-        # add a second of silence between clips
-        create_silence(save_path)
-        silence = AudioFileClip(os.path.join(save_path, "silence.mp3"))
-        voiceover = concatenate_audioclips([voiceover, silence, voiceover_comment])
-        voiceover_length += voiceover_comment_length
-    
-    # Get a random video and crop it to a random time interval of the audio length
-    video_file = os.path.join(background_folder, get_video(background_folder)[0])
-    background_clip = VideoFileClip(video_file, audio=False)
-
-    video_length = background_clip.duration
-    start_time = math.floor(random.random() * (video_length  - voiceover_length))
-    added_time = 2 if comment else 1
-    background_clip = background_clip.subclip(start_time, (start_time + voiceover_length + added_time))
-
-    # Crop it to be aspect ratio 9x16 for reels content
-    x, y = background_clip.size
-    width = y * (9/16)
-    if width % 2 == 1:
-        width += 1
-    x1 = math.floor((x / 2) - (width / 2))
-    x2 = math.ceil((x / 2) + (width / 2))
-    background_clip = crop(background_clip, x1=x1, y1=0, x2=x2, y2=y)
-    background_clip = background_clip.resize(height=1920, width=1080)
-
-    # Add reddit post image overlay
-    duration = voiceover_length - voiceover_comment_length if comment else voiceover_length
-    reddit_post = ImageClip(os.path.join(save_path, filename + ".png")).set_start(0).set_duration(duration + 1).set_pos(("center", "center"))
-
-    # Add reddit comment overlay if it exists
+    # The post card shows until the comment's voiceover starts,
+    # then the comment card shows until the end
+    overlays = [(post_image, 0, timings[1][0] if comment else length)]
     if comment:
-        comment_start_time = duration + 1
-        reddit_comment = ImageClip(os.path.join(save_path, filename + "_comment" + ".png")).set_start(comment_start_time).set_duration(voiceover_comment_length + 1).set_pos(("center", "center"))
+        overlays.append((comment_image, timings[1][0], length))
 
-    # Create the final clip with the voiceover audio
-    clips = [background_clip, reddit_post]
-    if comment:
-        clips.append(reddit_comment)
+    # Get a random video long enough for the voiceovers and a random keyframe to start at
+    background, start_time = get_background_library(background_folder).choose(length)
 
-    final_clip = CompositeVideoClip(clips).set_audio(voiceover)
-    final_clip.write_videofile(os.path.join(save_path, filename + ".mp4"), temp_audiofile=os.path.join(save_path, "temp.mp3"), codec='libx264', ffmpeg_params=['-vf', 'format=yuv420p'], preset='ultrafast')
+    VIDEO_BACKENDS[backend](os.path.join(save_path, filename + ".mp4"), background, start_time, length,
+                            overlays, audio)
 
-    background_clip.close()
-    reddit_post.close()
-    if comment:
-        reddit_comment.close()
-    final_clip.close()
+    return timings
 
 
 if __name__ == "__main__":
-    create_video('test_video', './gaming_videos')
\ No newline at end of file
+    create_video('test_video', 'test_video.png')
@@ -1,8 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
+from utilities.asset_cache import AssetCache
+from dataclasses import dataclass, field
+from abc import ABC, abstractmethod
+from contextlib import closing
+from botocore.config import Config
 from dotenv import load_dotenv
+import numpy as np
+import threading
+import hashlib
 import boto3
+import html
+import json
+import wave
+import io
+import re
 import os
 
 
+# The voice settings of every synthesize_speech request. Chunks are synthesized as raw
+# 16 bit mono samples so they join without the encoder delay and padding of separate mp3s
+VOICE = {'Engine': 'neural', 'OutputFormat': 'pcm', 'SampleRate': '16000', 'VoiceId': 'Matthew'}
+# Most synthesis requests in flight at once
+MAX_SYNTHESIS_WORKERS = 8
+# Size in bytes of the pieces an audio stream is read in
+STREAM_CHUNK = 64 * 1024
+# Polly bills at most 3000 characters per request, so longer SSML is split into chunks
+MAX_SSML_CHARACTERS = 3000
+# A sentence with its closing punctuation and trailing whitespace, or a line ending in newlines
+PIECE_PATTERN = re.compile(r".*?(?:[.!?]+[\"')\]]*\s*|\n+|$)", re.S)
+# Reserved SSML characters and their escape characters
+SSML_ESCAPES = {'&': "&amp;", '"': "&quot;", "'": "&apos;", '<': "&lt;", '>': "&gt;"}
+# A reserved character, or a run of newlines which becomes one <break />
+SSML_PATTERN = re.compile(r"\n+|[&\"'<>]")
+# Default size limit of the voiceover cache in MB
+VOICEOVER_CACHE_SIZE = 512
+# Default number of days a cached voiceover is kept
+VOICEOVER_CACHE_DAYS = 30
+
+# Speaking rate of the tone backend at 100% speed, close to Polly's neural voices
+WORDS_PER_MINUTE = 160
+# Length in seconds of the pause the tone backend makes for a <break />
+BREAK_SECONDS = 0.4
+# Sample rate of the tone backend's audio, the same as the Polly voice
+TONE_SAMPLE_RATE = int(VOICE['SampleRate'])
+
+_polly = None
+_polly_lock = threading.Lock()
+_voiceover_cache = None
+_voiceover_cache_lock = threading.Lock()
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+@dataclass
+class Voiceover:
+    '''
+    A voiceover segment (the post or the comment) written to disk, with its length
+    in seconds (None if it wasn't synthesized in this run) and the (start, end) times
+    of the chunks it was synthesized in.
+    '''
+    path: str
+    duration: float = None
+    chunk_times: list = field(default_factory=list)
+
+
+def escape_ssml(match):
+    '''
+    Return the SSML for a reserved character or run of newlines matched by SSML_PATTERN.
+    '''
+    text = match.group()
+
+    return "<break />" if text[0] == "\n" else SSML_ESCAPES[text]
+
+
 def format_ssml(text, speed=100):
     '''
     Given a string and optional speed, format it using AWS Polly's SSML syntax.
@@ -11,20 +81,8 @@ def format_ssml(text, speed=100):
     prefix = "<speak><prosody rate=\"{}%\">".format(speed)
     suffix = "</prosody></speak>"
 
-    # Exchange reserved characters for their ssml escaoe characters
-    text = text.replace("&", "&amp;")
-    text = text.replace("\"", "&quot;")
-    text = text.replace("'", "&apos;")
-    text = text.replace("<", "&lt;")
-    text = text.replace(">", "&gt;")
-
-    # Turn newlines into <break />, adding only one <break /> if there are multiple \n in a row
-    characters = [*text]
-    for i in range(len(characters) - 1, 0, -1):
-        if characters[i] == characters[i-1] == '\n':
-            del characters[i]
-
-    ssml = ("".join(characters)).replace('\n', "<break />")
+    # Escape reserved characters and turn each run of newlines into one <break /> in a single pass
+    ssml = SSML_PATTERN.sub(escape_ssml, text)
 
     # Add beginning and ending parts
     ssml = prefix + ssml + suffix
@@ -32,22 +90,274 @@ def format_ssml(text, speed=100):
     return ssml
 
 
-def create_voiceover(post, filename, comment=None):
+def format_ssml_batch(texts, speed=100):
+    '''
+    Given a list of strings and a speed (or a list with a speed for each),
+    format them all using AWS Polly's SSML syntax.
+    '''
+    speeds = speed if isinstance(speed, (list, tuple)) else [speed] * len(texts)
+
+    return [format_ssml(text, speed=speed) for text, speed in zip(texts, speeds)]
+
+
+def get_polly_client():
+    '''
+    Return the Polly client shared by everything in the process, creating it on first use
+    with the credentials saved in .env.
+    '''
+    global _polly
+    with _polly_lock:
+        if _polly is None:
+            load_dotenv()
+            _polly = boto3.client(
+                'polly',
+                region_name=os.getenv('AWS_REGION'),
+                aws_access_key_id=os.getenv('POLLY_ACCESS'),
+                aws_secret_access_key=os.getenv('POLLY_SECRET'),
+                config=Config(max_pool_connections=MAX_SYNTHESIS_WORKERS),
+            )
+
+    return _polly
+
+
+def get_voiceover_cache():
+    '''
+    Return the voiceover cache shared by everything in the process, opening it on first use.
+    The folder is set by VOICEOVER_CACHE in .env and defaults to voiceover_cache.
+    VOICEOVER_CACHE_SIZE (in MB) and VOICEOVER_CACHE_DAYS optionally set how much
+    audio is kept and for how long.
+    '''
+    global _voiceover_cache
+    with _voiceover_cache_lock:
+        if _voiceover_cache is None:
+            load_dotenv()
+            _voiceover_cache = AssetCache(
+                os.getenv('VOICEOVER_CACHE', 'voiceover_cache'),
+                max_bytes=float(os.getenv('VOICEOVER_CACHE_SIZE', VOICEOVER_CACHE_SIZE)) * 1024 * 1024,
+                max_age=float(os.getenv('VOICEOVER_CACHE_DAYS', VOICEOVER_CACHE_DAYS)) * 24 * 60 * 60,
+            )
+
+    return _voiceover_cache
+
+
+def voiceover_key(ssml):
+    '''
+    Return the cache key of an SSML document synthesized with the VOICE settings.
+    '''
+    parts = [ssml, VOICE['VoiceId'], VOICE['Engine'], VOICE['SampleRate'], VOICE['OutputFormat']]
+
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def split_pieces(text, budget, speed=100):
+    '''
+    Split text into the pieces chunks are made of: sentences (with their trailing
+    whitespace and line breaks), or words and then single characters for sentences
+    whose SSML is longer than budget characters.
+    '''
+    overhead = len(format_ssml("", speed=speed))
+
+    for piece in PIECE_PATTERN.findall(text):
+        if len(format_ssml(piece, speed=speed)) - overhead <= budget:
+            yield piece
+            continue
+
+        for word in re.findall(r"\S+\s*|\s+", piece):
+            if len(format_ssml(word, speed=speed)) - overhead <= budget:
+                yield word
+            else:
+                yield from word
+
+
+def split_text(text, speed=100, limit=MAX_SSML_CHARACTERS):
+    '''
+    Split text at sentence ends and line breaks into chunks whose SSML is at most
+    limit characters long, so each can be synthesized in one request.
+    Joining the chunks gives back the original text.
+    '''
+    overhead = len(format_ssml("", speed=speed))
+    budget = limit - overhead
+
+    chunks = []
+    chunk = ""
+    size = 0
+    for piece in split_pieces(text, budget, speed=speed):
+        if piece == "":
+            continue
+        # Formatting pieces separately can only overestimate the length of the chunk
+        length = len(format_ssml(piece, speed=speed)) - overhead
+        if chunk != "" and size + length > budget:
+            chunks.append(chunk)
+            chunk = ""
+            size = 0
+        chunk += piece
+        size += length
+
+    if chunk != "" or len(chunks) == 0:
+        chunks.append(chunk)
+
+    return chunks
+
+
+def synthesize(ssml):
+    '''
+    Synthesize an SSML document with Polly, streaming the audio in as it arrives,
+    and return the raw 16 bit samples along with their duration in seconds.
+    Audio that was synthesized before is served from the voiceover cache instead.
+    '''
+    cache = get_voiceover_cache()
+    key = voiceover_key(ssml)
+
+    voiceover, metadata = cache.get_with_metadata(key)
+    if voiceover is not None:
+        return voiceover, metadata['duration']
+
+    response = get_polly_client().synthesize_speech(Text=ssml, TextType='ssml', **VOICE)
+
+    chunks = []
+    with closing(response['AudioStream']) as stream:
+        for chunk in stream.iter_chunks(STREAM_CHUNK):
+            chunks.append(chunk)
+
+    voiceover = b"".join(chunks)
+    duration = len(voiceover) // 2 / int(VOICE['SampleRate'])
+    cache.put(key, voiceover, {'duration': duration, **VOICE})
+
+    return voiceover, duration
+
+
+def to_wav(samples, sample_rate):
+    '''
+    Given the bytes of mono 16 bit samples, return them as a wav file.
+    '''
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(samples)
+
+    return buffer.getvalue()
+
+
+class TTSBackend(ABC):
+    '''
+    The interface create_voiceover synthesizes speech through.
+    extension is the file extension of the audio the backend makes.
+    '''
+    extension = None
+
+    @abstractmethod
+    def synthesize(self, ssml):
+        '''
+        Synthesize an SSML document and return its audio along with its duration in seconds.
+        '''
+
+    @abstractmethod
+    def join(self, voiceovers):
+        '''
+        Join the audio of several synthesized chunks into one file, in order.
+        '''
+
+
+class PollyBackend(TTSBackend):
+    '''
+    Synthesizes speech with AWS Polly, through the shared client and voiceover cache.
+    The chunks are joined sample for sample and written out once as a wav file.
+    '''
+    extension = "wav"
+
+    def synthesize(self, ssml):
+        return synthesize(ssml)
+
+    def join(self, voiceovers):
+        return to_wav(b"".join(voiceovers), int(VOICE['SampleRate']))
+
+
+class ToneBackend(TTSBackend):
+    '''
+    An offline stand-in for a speech engine, for running and benchmarking the pipeline
+    without network access or credentials. Each word becomes a short tone at the
+    prosody rate of the SSML and each <break /> a pause, so the wav it makes is
+    about as long as real speech would be and is the same every time.
+    '''
+    extension = "wav"
+
+    def synthesize(self, ssml):
+        rate = re.search(r'<prosody rate="(\d+)%">', ssml)
+        speed = int(rate.group(1)) / 100 if rate is not None else 1
+        word_samples = int(TONE_SAMPLE_RATE * 60 / (WORDS_PER_MINUTE * speed))
+
+        # A word is a 220Hz tone for 80% of its time followed by silence
+        tone_samples = int(word_samples * 0.8)
+        word = np.zeros(word_samples, dtype=np.int16)
+        word[:tone_samples] = 3000 * np.sin(2 * np.pi * 220 * np.arange(tone_samples) / TONE_SAMPLE_RATE)
+        pause = np.zeros(int(TONE_SAMPLE_RATE * BREAK_SECONDS), dtype=np.int16)
+
+        parts = []
+        for i, text in enumerate(re.sub(r"<(?!break)[^>]*>", "", ssml).split("<break />")):
+            if i > 0:
+                parts.append(pause)
+            parts.extend(word for _ in html.unescape(text).split())
+
+        samples = np.concatenate(parts) if len(parts) > 0 else np.zeros(0, dtype=np.int16)
+
+        return to_wav(samples.tobytes(), TONE_SAMPLE_RATE), len(samples) / TONE_SAMPLE_RATE
+
+    def join(self, voiceovers):
+        frames = []
+        for voiceover in voiceovers:
+            with wave.open(io.BytesIO(voiceover), "rb") as wav:
+                frames.append(np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16))
+
+        return to_wav(np.concatenate(frames).tobytes(), TONE_SAMPLE_RATE)
+
+
+# The backends TTS_BACKEND can choose from
+TTS_BACKENDS = {'polly': PollyBackend, 'tone': ToneBackend}
+
+
+def get_tts_backend(name=None):
     '''
-    Uses the AWS Polly API to create a voiceover of a reddit post.
+    Return the TTS backend with a name, creating it on first use. The name defaults to
+    TTS_BACKEND in .env, or "polly" if that isn't set.
     '''
     load_dotenv()
-    region = os.getenv('AWS_REGION')
-    polly_access = os.getenv('POLLY_ACCESS')
-    polly_secret = os.getenv('POLLY_SECRET')
-    save_path = os.getenv('SAVE_PATH')
+    name = name or os.getenv('TTS_BACKEND', 'polly')
+    if name not in TTS_BACKENDS:
+        raise Exception(f"Unknown TTS backend {name}")
 
-    client = boto3.client(
-        'polly', 
-        region_name=region,
-        aws_access_key_id=polly_access,
-        aws_secret_access_key=polly_secret,
-    )
+    with _backends_lock:
+        if name not in _backends:
+            _backends[name] = TTS_BACKENDS[name]()
+
+    return _backends[name]
+
+
+def synthesize_all(documents, backend):
+    '''
+    Given a list of SSML documents, synthesize them all at the same time with a backend
+    and return a list of their (audio, duration) pairs.
+    '''
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_SYNTHESIS_WORKERS, len(documents)))) as executor:
+        # list() waits for every document and raises the first error
+        return list(executor.map(backend.synthesize, documents))
+
+
+def create_voiceover(post, filename, comment=None, backend=None):
+    '''
+    Creates a voiceover of a reddit post and its comment with a TTS backend
+    (see get_tts_backend), AWS Polly by default.
+
+    Text too long for one request is split into chunks at sentences and line breaks.
+    The chunks of the post and comment are all synthesized at the same time, then the
+    audio of each is joined back together in order.
+
+    Returns a Voiceover for the post and one for the comment if it was given.
+    '''
+    load_dotenv()
+    save_path = os.getenv('SAVE_PATH')
+    backend = get_tts_backend(backend)
 
     # Get the total word count to set the speed for the voiceover
     wordcount = len(post['title'].split()) + len(post['body'].split())
@@ -57,39 +367,34 @@ def create_voiceover(post, filename, comment=None):
     # then gradually speeds up the talking until you get to 200% at 480 words
     speed = min(int(max(105, (wordcount + 320) * 0.25)), 200)
 
-    ssml = format_ssml(post['title']+"\n"+post['body'], speed=speed)
+    texts = [post['title']+"\n"+post['body']]
+    paths = [os.path.join(save_path, filename + "." + backend.extension)]
 
-    response = client.synthesize_speech(
-        Engine='neural',
-        OutputFormat='mp3',
-        SampleRate='24000',
-        Text=ssml,
-        TextType='ssml',
-        VoiceId='Matthew'
-    )
+    # Do the same for the comment
+    if comment is not None:
+        texts.append(comment['body'])
+        paths.append(os.path.join(save_path, filename + "_comment" + "." + backend.extension))
 
-    voiceover = response['AudioStream'].read()
+    chunked = [split_text(text, speed=speed) for text in texts]
+    results = synthesize_all(format_ssml_batch([chunk for chunks in chunked for chunk in chunks], speed=speed), backend)
 
-    with open(os.path.join(save_path, filename + ".mp3"), "wb") as binary_file:
-        binary_file.write(voiceover)
+    voiceovers = []
+    for chunks, path in zip(chunked, paths):
+        segment = results[:len(chunks)]
+        results = results[len(chunks):]
 
-    # Do the same for the comment
-    if comment is not None:
-        ssml = format_ssml(comment['body'], speed=speed)
-
-        response = client.synthesize_speech(
-        Engine='neural',
-        OutputFormat='mp3',
-        SampleRate='24000',
-        Text=ssml,
-        TextType='ssml',
-        VoiceId='Matthew'
-        )
-        
-        voiceover = response['AudioStream'].read()
-
-        with open(os.path.join(save_path, filename + "_comment" + ".mp3"), "wb") as binary_file:
-            binary_file.write(voiceover)
+        with open(path, "wb") as binary_file:
+            binary_file.write(backend.join([voiceover for voiceover, _ in segment]))
+
+        chunk_times = []
+        start = 0
+        for _, duration in segment:
+            chunk_times.append((start, start + duration))
+            start += duration
+
+        voiceovers.append(Voiceover(path, start, chunk_times))
+
+    return voiceovers
 
 
 if __name__ == "__main__":